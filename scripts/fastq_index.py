@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
-import argparse, gzip, re, sys
+import argparse, gzip, re, sys, warnings
+import numpy as np
 import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import combinations, islice, product
 from pathlib import Path
-from typing import Union, List
+from typing import Union, List, Tuple
 
 
 # Dual Indexes
@@ -24,31 +29,6 @@ adapter_index = {
     # "CCAACA": 36, "CGGAAT": 37, "CTAGCT": 38, "CTATAC": 39, "GTGATC": 40,
     # "GACGAC": 41, "TAATCG": 42, "TACAGC": 43, "TATAAT": 44, "TCATTC": 45,
     # "TCCCGA": 46, "TCGAAG": 47, "TCGGCA": 48,
-    # NEB Dual Index: Reverse Complement Workflow
-    # "CGTATTCG": "A1", "TCAAGGAC": "B1", "AAGCACTG": "C1", "GCAATGGA": "D1",
-    # "CAATCGAC": "E1", "GGCGTTAT": "F1", "GTTAAGGC": "G1", "CCTATACC": "H1",
-    # "CTCCTAGA": "A2", "GTTACGCA": "B2", "CTAGCAAG": "C2", "ATCTCGCT": "D2",
-    # "GTGCCATA": "E2", "GGTGATTC": "F2", "CACCTTAC": "G2", "TTCTCTCG": "H2",
-    # "TAGTTGCG": "A3", "AGTCTGTG": "B3", "TGCTTCCA": "C3", "GGCTATTG": "D3",
-    # "TGTTCGAG": "E3", "AACTTGCC": "F3", "TGGTAGCT": "G3", "GTATGCTG": "H3",
-    # "GAGATACG": "A4", "GCACGTAA": "B4", "GCTTAGCT": "C4", "GGTGTCTT": "D4",
-    # "TGGAGTTG": "E4", "GCAAGATC": "F4", "CAGTGAAG": "G4", "AAGTCGAG": "H4",
-    # "AGGTGTAC": "A5", "AACCTTGG": "B5", "AACCGTTC": "C5", "TCAACTGG": "D5",
-    # "ACGATGAC": "E5", "TCGCATTG": "F5", "GTTCAACC": "G5", "AACCGAAG": "H5",
-    # "TAATGCCG": "A6", "ATTGCGTG": "B6", "GACATTCC": "C6", "CTTCACCA": "D6",
-    # "TGATGTCC": "E6", "TGTACACC": "F6", "TGGCTATC": "G6", "TGTTGTGG": "H6",
-    # "GTCGGTAA": "A7", "TCAGACGA": "B7", "ACCTGGAA": "C7", "AGACCGTA": "D7",
-    # "ACGGTCTT": "E7", "TGAACCTG": "F7", "AGCTCCTA": "G7", "CTGGAGTA": "H7",
-    # "AGGTCACT": "A8", "GATAGGCT": "B8", "GGAGATGA": "C8", "GATACTGG": "D8",
-    # "TCTCGCAA": "E8", "CTTCGTTC": "F8", "GCAATTCG": "G8", "TCTCTTCC": "H8",
-    # "GAATCCGA": "A9", "TGGTACAG": "B9", "GTACTCTC": "C9", "TGCGTAGA": "D9",
-    # "GGAATTGC": "E9", "CTTCTGAG": "F9", "CTTAGGAC": "G9", "TCTAACGC": "H9",
-    # "GTACCTTG": "A10", "CAAGGTCT": "B10", "GTAACGAC": "C10", "TCGGTTAC": "D10",
-    # "ACGGATTC": "E10", "TGCTCATG": "F10", "GTCCTAAG": "G10", "GGTCAGAT": "H10",
-    # "CATGAGGA": "A11", "GCTATCCT": "B11", "ATTCCTCC": "C11", "ATGACGTC": "D11",
-    # "TTAAGCGG": "E11", "AGTTCGTC": "F11", "AACGTGGA": "G11", "CTCTGGTT": "H11",
-    # "TGACTGAC": "A12", "ATGGAAGG": "B12", "GTGTTCCT": "C12", "GCTGTAAG": "D12",
-    # "TGCAGGTA": "E12", "TAGCGTCT": "F12", "CTGTGTTG": "G12", "TGTGGTAC": "H12",
     # NEB Single Index
     "ATCACG": '1', "CGATGT": '2', "TTAGGC": '3', "TGACCA": '4', "ACAGTG": '5',
     "GCCAAT": '6', "CAGATC": '7', "ACTTGA": '8', "GATCAG": '9', "TAGCTT": '10',
@@ -87,55 +67,179 @@ adapter_index = {
     "GGACATCA": "E12", "GGTGTACA": "F12", "GATAGCCA": "G12", "CCACAACA": "H12"
 }
 
+# NEB Dual Index: Reverse Complement Workflow
+# Kept apart from adapter_index as some keys are also NEB Dual i7 keys for other wells (see BarcodeMatcher)
+adapter_index_rc = {
+    "CGTATTCG": "A1", "TCAAGGAC": "B1", "AAGCACTG": "C1", "GCAATGGA": "D1",
+    "CAATCGAC": "E1", "GGCGTTAT": "F1", "GTTAAGGC": "G1", "CCTATACC": "H1",
+    "CTCCTAGA": "A2", "GTTACGCA": "B2", "CTAGCAAG": "C2", "ATCTCGCT": "D2",
+    "GTGCCATA": "E2", "GGTGATTC": "F2", "CACCTTAC": "G2", "TTCTCTCG": "H2",
+    "TAGTTGCG": "A3", "AGTCTGTG": "B3", "TGCTTCCA": "C3", "GGCTATTG": "D3",
+    "TGTTCGAG": "E3", "AACTTGCC": "F3", "TGGTAGCT": "G3", "GTATGCTG": "H3",
+    "GAGATACG": "A4", "GCACGTAA": "B4", "GCTTAGCT": "C4", "GGTGTCTT": "D4",
+    "TGGAGTTG": "E4", "GCAAGATC": "F4", "CAGTGAAG": "G4", "AAGTCGAG": "H4",
+    "AGGTGTAC": "A5", "AACCTTGG": "B5", "AACCGTTC": "C5", "TCAACTGG": "D5",
+    "ACGATGAC": "E5", "TCGCATTG": "F5", "GTTCAACC": "G5", "AACCGAAG": "H5",
+    "TAATGCCG": "A6", "ATTGCGTG": "B6", "GACATTCC": "C6", "CTTCACCA": "D6",
+    "TGATGTCC": "E6", "TGTACACC": "F6", "TGGCTATC": "G6", "TGTTGTGG": "H6",
+    "GTCGGTAA": "A7", "TCAGACGA": "B7", "ACCTGGAA": "C7", "AGACCGTA": "D7",
+    "ACGGTCTT": "E7", "TGAACCTG": "F7", "AGCTCCTA": "G7", "CTGGAGTA": "H7",
+    "AGGTCACT": "A8", "GATAGGCT": "B8", "GGAGATGA": "C8", "GATACTGG": "D8",
+    "TCTCGCAA": "E8", "CTTCGTTC": "F8", "GCAATTCG": "G8", "TCTCTTCC": "H8",
+    "GAATCCGA": "A9", "TGGTACAG": "B9", "GTACTCTC": "C9", "TGCGTAGA": "D9",
+    "GGAATTGC": "E9", "CTTCTGAG": "F9", "CTTAGGAC": "G9", "TCTAACGC": "H9",
+    "GTACCTTG": "A10", "CAAGGTCT": "B10", "GTAACGAC": "C10", "TCGGTTAC": "D10",
+    "ACGGATTC": "E10", "TGCTCATG": "F10", "GTCCTAAG": "G10", "GGTCAGAT": "H10",
+    "CATGAGGA": "A11", "GCTATCCT": "B11", "ATTCCTCC": "C11", "ATGACGTC": "D11",
+    "TTAAGCGG": "E11", "AGTTCGTC": "F11", "AACGTGGA": "G11", "CTCTGGTT": "H11",
+    "TGACTGAC": "A12", "ATGGAAGG": "B12", "GTGTTCCT": "C12", "GCTGTAAG": "D12",
+    "TGCAGGTA": "E12", "TAGCGTCT": "F12", "CTGTGTTG": "G12", "TGTGGTAC": "H12"
+}
+
 
-def fastq_index(path: Union[str, Path], suffix: str = 'gz') -> Union[List[str], pd.DataFrame]:
+class BarcodeMatcher:
+    """
+    Resolves barcode keys to indexes with up to `mismatches` mismatches in O(1), using a table of every
+    sequence (over 'ACGTN') within `mismatches` of a barcode, precomputed from one or more index dicts.
+    A sequence resolves to the index of its nearest barcode; if barcodes of different indexes are equally
+    near, it is ambiguous: listed in `ambiguous` (with its candidate indexes), warned about when built, and resolved to '0'.
+
+    Example:
+    matcher = BarcodeMatcher(adapter_index, adapter_index_rc, mismatches=1)
+    matcher['TTACCGAT'] -> 'A1'
+    matcher.match_many(keys) -> array of indexes, for millions of keys
+    """
+    def __init__(self, *indexes: dict, mismatches: int = 1, alphabet: str = 'ACGTN', warn: bool = True):
+        self.mismatches = mismatches
+        nearest = {}  # seq -> (distance, {indexes})
+        for index in indexes or (adapter_index,):
+            for barcode, idx in index.items():
+                for seq, dist in self.neighbors(barcode, mismatches, alphabet):
+                    best = nearest.get(seq)
+                    if best is None or dist < best[0]: nearest[seq] = (dist, {idx})
+                    elif dist == best[0]: best[1].add(idx)
+        self.table = {seq: idxs.pop() for seq, (_, idxs) in nearest.items() if len(idxs) == 1}
+        self.ambiguous = {seq: sorted(idxs) for seq, (_, idxs) in nearest.items() if len(idxs) > 1}
+        if warn and self.ambiguous:
+            exact = sorted(seq for seq, (dist, _) in nearest.items() if dist == 0 and seq in self.ambiguous)
+            warnings.warn(f"BarcodeMatcher: {len(self.ambiguous)} ambiguous keys with mismatches={mismatches}"
+                          + (f", including barcodes assigned to several indexes: {exact}" if exact else ''))
+
+    @staticmethod
+    def neighbors(barcode: str, mismatches: int, alphabet: str = 'ACGTN'):
+        "Yields (seq, distance) for every seq within `mismatches` of `barcode`"
+        yield barcode, 0
+        for dist in range(1, mismatches + 1):
+            for positions in combinations(range(len(barcode)), dist):
+                choices = [[b for b in alphabet if b != barcode[p]] for p in positions]
+                for bases in product(*choices):
+                    seq = list(barcode)
+                    for p, b in zip(positions, bases): seq[p] = b
+                    yield ''.join(seq), dist
+
+    def __getitem__(self, key: str) -> str:
+        return self.table.get(key, '0')
+
+    def match_many(self, keys) -> np.ndarray:
+        "Resolves an iterable or Series of keys at once, returning an array of indexes ('0' if none)"
+        return pd.Series(keys, dtype=object).map(self.table).fillna('0').to_numpy()
+
+    def match_headers(self, headers) -> np.ndarray:
+        """
+        Resolves the index of each FASTQ header at once, with the priority of `header_index`:
+        full LH key, then RH key, then the first 6 ch of the LH key (NEB Single Index)
+        """
+        keys = pd.Series(headers, dtype=object).str.strip().str.split(':').str[-1].str.split('+')
+        key1, key2 = keys.str[0], keys.str[1].fillna('')
+        idx1, idx2, idx0 = self.match_many(key1), self.match_many(key2), self.match_many(key1.str[0:6])
+        return np.where(idx1 != '0', idx1, np.where(idx2 != '0', idx2, idx0))
+
+@lru_cache(maxsize=None)
+def barcode_matcher(mismatches: int = 0) -> BarcodeMatcher:
+    "Returns the BarcodeMatcher for `adapter_index` with `mismatches`, built once"
+    return BarcodeMatcher(adapter_index, mismatches=mismatches)
+
+def lookup_index(key: str, mismatches: int = 0) -> str:
+    "Returns the index of `key` in `adapter_index` within `mismatches` (see BarcodeMatcher), or '0' if none"
+    return barcode_matcher(mismatches)[key]
+
+def header_index(header: str, mismatches: int = 0) -> str:
+    """
+    Returns the index of a FASTQ header, or '0' if none.
+    LH and RH keys are both 8 ch long
+    NEB Single Index is first 6 ch of LH key
+    NEB Dual Indexes are either full LH or RH
+    """
+    return barcode_matcher(mismatches).match_headers([header])[0]
+
+def fastq_index_sample(file_path: Union[str, Path], n_reads: int = 10000, mismatches: int = 1,
+                       top: int = 3) -> Tuple[str, float, List[Tuple[str, float]]]:
+    """
+    Tally the indexes of the first `n_reads` reads of a fastq.gz file, decompressing only that prefix.
+    Keys are resolved within `mismatches` (see BarcodeMatcher).
+    Returns (dominant index, its fraction of the sampled reads, [(index, fraction)] of the `top` contaminating indexes).
+    Unassigned reads ('0') count towards the total but are never reported as contaminants.
+    """
+    with gzip.open(file_path, 'rt') as f:
+        tally = Counter(barcode_matcher(mismatches).match_headers(list(islice(f, 0, 4 * n_reads, 4))))
+    total = sum(tally.values())
+    if not total: return '0', 0.0, []
+    ranked = [(idx, count / total) for idx, count in tally.most_common() if idx != '0']
+    if not ranked: return '0', tally['0'] / total, []
+    return ranked[0][0], ranked[0][1], ranked[1:top + 1]
+
+def fastq_index(path: Union[str, Path], suffix: str = 'gz', n_reads: int = 1, mismatches: int = 0,
+                jobs: int = 16) -> Union[List[str], pd.DataFrame]:
     """
     Examine fastq.gz formatted files and determine the Index used during library preparation.
     Handles both single and dual indexes from NEB.
     Returns a list for single files or a pandas DataFrame for multiple files.
+    Files are opened and read concurrently by `jobs` threads, hiding the latency of network storage.
+    By default the Index is taken from the first read. With `n_reads` > 1, the first `n_reads` are tallied
+    (see fastq_index_sample) and 'Fraction' and 'Contaminants' are added to the result.
     """
+    sampled = n_reads > 1
+    columns = ['SampleID', 'Index', 'FullID', 'Path'] + (['Fraction', 'Contaminants'] if sampled else [])
     def process_file(file_path):
         try:
             match = re.search(r'-(.+?)_.*_(R[12])_', file_path.name)
             sample_id, std = match.groups() if match else ('0', '0')
             std = std[-1]  # Ensure std is only '1' or '2'
             full_id = f'{sample_id}_R{std}' if sample_id != '0' else '0'
-
-            with gzip.open(file_path, 'rt') as f:
-                # LH and RH keys are both 8 ch long
-                # NEB Single Index is first 6 ch of LH key
-                # NEB Dual Indexes are either full LH or RH
-                # There should only be a single idx returned
-                key1, key2 = next(f).strip().split(':')[-1].split('+')
-                key0 = key1[0:6]
-                idx0, idx1, idx2 = adapter_index.get(key0, '0') ,adapter_index.get(key1, '0'),adapter_index.get(key2, '0')
-                #print([idx0, idx1, idx2])
-                indx = idx1 if idx1 != '0' else idx2
-                if indx == '0': indx = idx0
-            return [sample_id, indx, full_id, str(file_path)]
+            if not sampled:
+                with gzip.open(file_path, 'rt') as f:
+                    indx = header_index(next(f), mismatches)
+                return [sample_id, indx, full_id, str(file_path)]
+            indx, fraction, contaminants = fastq_index_sample(file_path, n_reads, mismatches)
+            contaminants = ','.join(f'{idx}:{frac:.4f}' for idx, frac in contaminants)
+            return [sample_id, indx, full_id, str(file_path), round(fraction, 4), contaminants]
         except Exception:
-            return ['0', '0', '0', str(file_path)]
+            return ['0', '0', '0', str(file_path)] + ([0.0, ''] if sampled else [])
 
     path = Path(path)
     if path.is_file():
         return process_file(path)
     files = list(path.glob(f'*.{suffix}'))
     if not files:
-        return pd.DataFrame(columns=['SampleID', 'Index', 'FullID', 'Path'])
-    results = [process_file(f) for f in files]
-    return pd.DataFrame(results, columns=['SampleID', 'Index', 'FullID', 'Path']).sort_values('FullID')
+        return pd.DataFrame(columns=columns)
+    with ThreadPoolExecutor(max(1, min(jobs, len(files)))) as pool:
+        results = list(pool.map(process_file, files))
+    return pd.DataFrame(results, columns=columns).sort_values('FullID')
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process FASTQ files and determine the Index used during library preparation.")
     parser.add_argument("path", help="Path to a single FASTQ file or a directory containing FASTQ files")
     parser.add_argument("--suffix", default="gz", help="Suffix for FASTQ files (default: gz)")
+    parser.add_argument("--n_reads", type=int, default=1, help="Number of reads to sample; > 1 adds Fraction and Contaminants (default: 1)")
+    parser.add_argument("--mismatches", type=int, default=0, help="Mismatches tolerated when matching an index (default: 0)")
+    parser.add_argument("--jobs", type=int, default=16, help="Number of files read concurrently (default: 16)")
     args = parser.parse_args()
 
-    result = fastq_index(args.path, args.suffix)
+    result = fastq_index(args.path, args.suffix, args.n_reads, args.mismatches, args.jobs)
 
     if isinstance(result, list):
-        print("\t".join(result))
+        print("\t".join(map(str, result)))
     elif isinstance(result, pd.DataFrame):
         if not result.empty:
             result.to_csv(sys.stdout, sep='\t', index=False)
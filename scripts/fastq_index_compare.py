@@ -3,9 +3,10 @@
 from fastq_index import *
 import warnings
 
-def fastq_index_compare(path_dir: Union[str, Path], path_csv: Union[str, Path]) -> tuple[bool, pd.DataFrame]:
+def fastq_index_compare(path_dir: Union[str, Path], path_csv: Union[str, Path], jobs: int = 16) -> tuple[bool, pd.DataFrame]:
     """
     Compare actual indexes from FASTQ files to expected indexes in a CSV file.
+    FASTQ files are read concurrently by `jobs` threads (see fastq_index).
     Returns a tuple (success, df), where success is a bool: True if all indexes match, False otherwise.
     If success is True, returns the full merged DataFrame. Otherwise, returns a DataFrame of unmatched rows.
     """
@@ -16,7 +17,7 @@ def fastq_index_compare(path_dir: Union[str, Path], path_csv: Union[str, Path])
     if not path_csv.is_file():
         raise ValueError(f"CSV file not found: {path_csv}")
 
-    df = fastq_index(path_dir)
+    df = fastq_index(path_dir, jobs=jobs)
     dfi = pd.read_csv(path_csv, dtype=str)
     dfm = df.merge(dfi, on='SampleID')
 
@@ -36,10 +37,11 @@ if __name__ == "__main__":
     parser.add_argument("path_dir", help="Path to the directory containing FASTQ files")
     parser.add_argument("path_csv", help="Path to the experiment CSV file containing expected indexes")
     parser.add_argument("--merge", action="store_true", help="Print the full merged dataframe if successful")
+    parser.add_argument("--jobs", type=int, default=16, help="Number of FASTQ files read concurrently (default: 16)")
     args = parser.parse_args()
 
     try:
-        success, result = fastq_index_compare(args.path_dir, args.path_csv)
+        success, result = fastq_index_compare(args.path_dir, args.path_csv, args.jobs)
 
         if success:
             print("Success: All indexes match.", file=sys.stderr)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Finds the most common 6-mer barcodes immediately preceding an adapter
+# A single pass over each FASTQ counts reads, adapters and barcodes together; barcodes are tallied
+# in a fixed array of 4^6 counts rather than sorted. Files are processed in parallel.
+
+import argparse, os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Union
+import numpy as np
+from xopen import xopen
+
+BARCODE_LEN = 6
+
+# Base -> 2-bit code, and which bytes may occur in a barcode ('ACGT'; never '\n', so barcodes stay within a line)
+_codes = np.zeros(256, dtype=np.int64)
+_codes[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4)
+_is_base = np.zeros(256, dtype=bool)
+_is_base[np.frombuffer(b'ACGT', dtype=np.uint8)] = True
+_weights = 4 ** np.arange(BARCODE_LEN - 1, -1, -1)
+
+
+def adapter_hits(block: bytes, adapter: bytes) -> np.ndarray:
+    "Start offsets of all occurrences of `adapter` in `block` (overlapping ones included), found with `bytes.find`"
+    hits, i = [], block.find(adapter)
+    while i >= 0:
+        hits.append(i)
+        i = block.find(adapter, i + 1)
+    return np.array(hits, dtype=np.int64)
+
+
+def non_overlapping(starts: np.ndarray, width: int, keep: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Mask of the matches `starts` (ascending) of `width` bytes that a left-to-right scan (`grep -o`, `str.count`)
+    reports: those in `keep` not overlapping an earlier reported match. Only matches closer than `width` are looped over.
+    """
+    mask = np.ones(len(starts), dtype=bool) if keep is None else keep.copy()
+    for k in np.flatnonzero(np.diff(starts) < width) + 1:
+        j = k - 1
+        while mask[k] and j >= 0 and starts[k] - starts[j] < width:
+            if mask[j]: mask[k] = False
+            j -= 1
+    return mask
+
+
+def barcode_codes(block: bytes, hits: np.ndarray, adapter_len: int) -> np.ndarray:
+    "Integer codes of the 'ACGT' 6-mers immediately preceding adapter `hits` in `block`, as matched by `grep -o`"
+    starts = hits[hits >= BARCODE_LEN] - BARCODE_LEN
+    mers = np.frombuffer(block, dtype=np.uint8)[starts[:, None] + np.arange(BARCODE_LEN)]
+    valid = non_overlapping(starts, BARCODE_LEN + adapter_len, _is_base[mers].all(axis=1))
+    return _codes[mers[valid]] @ _weights
+
+
+def decode_barcode(code: int) -> str:
+    "Returns the 6-mer for an integer `code` of the barcode count array"
+    return ''.join('ACGT'[(code >> (2 * i)) & 3] for i in range(BARCODE_LEN - 1, -1, -1))
+
+
+def find_barcodes(file: Union[str, Path], adapter: str, top: int = 10, threads: int = 1,
+                  buffer_size: int = 1 << 24) -> dict:
+    """
+    Decompress `file` once and return a dict with:
+        - 'Path'
+        - 'Reads': total reads (lines / 4)
+        - 'Adapters': total occurrences of `adapter`
+        - 'Barcodes': the `top` [(6-mer, count)] immediately preceding `adapter`, most common first
+    Adapters are located once per buffer with a substring search and the 6 bases before each are counted.
+    Matches are found per line, as with `grep -o`.
+    """
+    adapter_b = adapter.encode()
+    counts = np.zeros(4 ** BARCODE_LEN, dtype=np.int64)
+    lines = adapters = 0
+    carry = b''
+    with xopen(file, 'rb', threads=threads) as fh:
+        while True:
+            buf = fh.read(buffer_size)
+            # Only search complete lines; the partial last line is carried into the next buffer
+            data = carry + buf
+            cut = data.rfind(b'\n') + 1 if buf else len(data)
+            block, carry = data[:cut], data[cut:]
+            if block:
+                lines += block.count(b'\n') + (not buf and not block.endswith(b'\n'))
+                hits = adapter_hits(block, adapter_b)
+                adapters += int(non_overlapping(hits, len(adapter_b)).sum())
+                codes = barcode_codes(block, hits, len(adapter_b))
+                if len(codes): counts += np.bincount(codes, minlength=len(counts))
+            if not buf: break
+    order = np.argsort(counts, kind='stable')[::-1][:top]
+    return {'Path': str(file), 'Reads': lines // 4, 'Adapters': adapters,
+            'Barcodes': [(decode_barcode(code), int(counts[code])) for code in order if counts[code]]}
+
+
+def find_barcodes_files(files: List[Union[str, Path]], adapter: str, top: int = 10,
+                        jobs: Optional[int] = None) -> List[dict]:
+    "Runs `find_barcodes` over `files` with `jobs` processes (default: one per file, up to the CPU count), returning results in order"
+    with ProcessPoolExecutor(jobs or min(len(files), os.cpu_count())) as pool:
+        return list(pool.map(find_barcodes, files, [adapter] * len(files), [top] * len(files)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds the most common 6-mer barcodes immediately preceding an adapter")
+    parser.add_argument("adapter", help="Adapter sequence")
+    parser.add_argument("files", nargs="+", help="FASTQ files (plain or compressed)")
+    parser.add_argument("--top", type=int, default=10, help="Number of barcodes to report (default: 10)")
+    parser.add_argument("--jobs", type=int, default=None, help="Files processed in parallel (default: up to the CPU count)")
+    args = parser.parse_args()
+
+    for result in find_barcodes_files(args.files, args.adapter, args.top, args.jobs):
+        if len(args.files) > 1: print(f"==> {result['Path']} <==")
+        for barcode, count in result['Barcodes']:
+            print(f"{count:7d} {barcode}")
+        print(f"{result['Adapters']} Total Adapters")
+        print(f"{result['Reads']} Total Reads")
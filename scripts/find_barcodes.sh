@@ -1,12 +1,9 @@
 #!/usr/bin/env sh
 
 # Finds 10 most common 6-mer barcodes immediately preceding an adapter
+# Thin wrapper around find_barcodes.py, which reads each file once; extra files are processed in parallel
 
 adapter=$1
-file=$2
+shift
 
-zcat -c "$file" | grep -o "[ATCG]\{6\}$adapter" | grep -o "^[ATCG]\{6\}" | sort | uniq -c | sort -rn 2> /dev/null| cat 2> /dev/null | head
-
-echo `zcat -c "$file" | grep -o "$adapter" | wc -l` Total Adapters
-
-echo `zcat -c "$file" | wc -l` Total Reads
+exec python3 "$(dirname "$0")/find_barcodes.py" "$adapter" "$@"
@@ -2,7 +2,14 @@
 
 # Example Usage: Find all CG positions on pUC19.fa for both positive and negative strands.
 
-import argparse, re
+import argparse, hashlib, mmap, os, shutil, sys
+from collections.abc import Iterator
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 def rev_comp(dna):
     "Find reverse complement of DNA with only: 'A','T','C','G'"
@@ -30,40 +37,241 @@ def rev_comp(dna):
     return ''.join([rc[nt.capitalize()] for nt in dna])
 
 
+def _fasta_entries(fasta_file) -> list:
+    """
+    Streams `fasta_file` one line at a time and returns [chrom, length, offset, bases per line, bytes per line]
+    per chrom, as in a `.fai` index. Chroms with irregular line wrapping get 0 bases and bytes per line.
+    """
+    entries, entry, offset, short, irregular = [], None, 0, False, False
+    def close():
+        if irregular: entry[3:] = [0, 0]
+        entries.append(entry)
+    with open(fasta_file, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if entry: close()
+                entry, short, irregular = [line[1:].split()[0].decode(), 0, offset + len(line), 0, 0], False, False
+            elif entry:
+                bases = len(line.rstrip(b'\r\n'))
+                if entry[3] == 0: entry[3:] = [bases, len(line)]
+                elif bases > entry[3] or (short and bases): irregular = True
+                short = short or bases < entry[3]
+                entry[1] += bases
+            offset += len(line)
+    if entry: close()
+    return entries
+
+def faidx(fasta_file):
+    """
+    Builds a samtools-compatible `fasta_file.fai` index, streaming the FASTA one line at a time.
+    Each line of the index is: chrom, length, offset, bases per line, bytes per line
+    """
+    fai = Path(f'{fasta_file}.fai')
+    entries = _fasta_entries(fasta_file)
+    if (irregular := next((entry[0] for entry in entries if entry[1] and not entry[3]), None)):
+        raise ValueError(f'{fasta_file}: {irregular} has lines of different lengths')
+    with fai.open('w') as fh:
+        for entry in entries: print(*entry, sep='\t', file=fh)
+    return fai
+
+@lru_cache(maxsize=32)
+def _memory_index(fasta_file, size, mtime_ns) -> dict[str, tuple[int, int, int, int]]:
+    return {name: tuple(fields) for name, *fields in _fasta_entries(fasta_file)}
+
+def fasta_index(fasta_file) -> dict[str, tuple[int, int, int, int]]:
+    """
+    Returns {chrom: (length, offset, bases per line, bytes per line)} from `fasta_file.fai`,
+    building the index if it is missing or older than `fasta_file`.
+    A FASTA that cannot be indexed (irregular line wrapping) or whose index cannot be saved (read-only dir)
+    gets an index kept in memory instead; its irregular chroms have 0 bases per line and are read line by line.
+    """
+    fai = Path(f'{fasta_file}.fai')
+    stat = Path(fasta_file).stat()
+    try:
+        if not fai.exists() or fai.stat().st_mtime < stat.st_mtime: faidx(fasta_file)
+        with fai.open() as fh:
+            return {name: tuple(map(int, fields[:4])) for name, *fields in (line.split('\t') for line in fh)}
+    except (ValueError, OSError):
+        return _memory_index(str(fasta_file), stat.st_size, stat.st_mtime_ns)
+
+def _fasta_mmap(fasta_file):
+    with open(fasta_file, 'rb') as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _read_bases(mm, length, offset, linebases, linewidth, start=0, end=None) -> np.ndarray:
+    "Returns bases [`start`, `end`) of a chrom as a uint8 array, copying once; `start` must begin a line"
+    end = length if end is None else min(end, length)
+    pos = offset + start // linebases * linewidth
+    nfull, rem = divmod(end - start, linebases)
+    out = np.empty(end - start, dtype=np.uint8)
+    if nfull:
+        lines = np.frombuffer(mm, dtype=np.uint8, count=(nfull - 1) * linewidth + linebases, offset=pos)
+        out[:nfull * linebases].reshape(nfull, linebases)[:] = as_strided(lines, (nfull, linebases), (linewidth, 1))
+    if rem:
+        out[nfull * linebases:] = np.frombuffer(mm, dtype=np.uint8, count=rem, offset=pos + nfull * linewidth)
+    return out
+
+def _read_irregular(mm, offset) -> bytes:
+    "Returns the bases of a chrom with irregular line wrapping starting at `offset`, up to the next header"
+    end = mm.find(b'\n>', offset)
+    return mm[offset:len(mm) if end < 0 else end].translate(None, b'\r\n')
+
+def read_chrom(fasta_file, chr, index=None, mm=None) -> memoryview:
+    """
+    Returns the sequence of `chr` as a memoryview, seeking straight to it with the `.fai` index.
+    A single-line sequence is returned as a zero-copy view of the memory-mapped file, otherwise
+    newlines are removed with a single copy. Peak memory is about one chromosome.
+    A chrom with irregular line wrapping (0 bases per line in an in-memory index) is read line by line.
+    """
+    index = index or fasta_index(fasta_file)
+    mm = mm or _fasta_mmap(fasta_file)
+    length, offset, linebases, linewidth = index[chr]
+    if length and not linebases: return memoryview(_read_irregular(mm, offset))
+    if length <= linebases or linebases == linewidth:
+        return memoryview(mm)[offset:offset + length]
+    return memoryview(_read_bases(mm, length, offset, linebases, linewidth))
+
+def iter_fasta(fasta_file) -> Iterator[tuple[str, memoryview]]:
+    "Yields (chrom, sequence) one chromosome at a time, as in `read_chrom`"
+    index, mm = fasta_index(fasta_file), _fasta_mmap(fasta_file)
+    for chr in index:
+        yield chr, read_chrom(fasta_file, chr, index, mm)
+
 def fasta2seq(fasta_file, chr=None):
-    sections = open(fasta_file, 'r').read().split('>')
+    "Returns the sequence of `chr` as a str; `chr` may be omitted for a FASTA with a single chromosome"
+    index = fasta_index(fasta_file)
     if chr is not None:
-        matched_section = next((s for s in sections if re.match(rf"^{chr}\b", s)), None)
-        if matched_section:
-            return '\n'.join(matched_section.splitlines()[1:]).replace('\n', '')
+        if chr in index: return bytes(read_chrom(fasta_file, chr, index)).decode()
         print(f"Error: No sequence found matching chr: {chr}")
         return None
-    else:
-        if len(sections) > 2:  # Check if there are multiple sections
-            print("Error: Multiple sections found in the FASTA file; please specify a chromosome header with --chr.")
-            return None
-        return '\n'.join(sections[1].splitlines()[1:]).replace('\n', '')
+    if len(index) > 1:
+        print("Error: Multiple sections found in the FASTA file; please specify a chromosome header with --chr.")
+        return None
+    return bytes(read_chrom(fasta_file, next(iter(index)), index)).decode()
 
-def find_cmers(seq, cmer, c_offset = 0, std='both'):
-    """
-    Returns the positions (1-based) of the 'C' in a cmer of either 'pos', 'neg' or both (default) strands.
-    If the target 'C' is not at start of cmer, then set `c_offset` (default=0)
-    """
+def check_cmer(cmer, c_offset=0):
+    "Returns a usage message if `cmer` or `c_offset` are invalid, otherwise None"
     if not all([n in 'ATCG' for n in cmer]) or 'C' not in cmer:
         return('usage: cmer must contain only "ATCG" and at least on "C" ')
     if cmer[c_offset] != 'C':
         return(f'usage: "No C" located in cmer={cmer} at "c_offset={c_offset}"')
-    #print(seq)
-    #print(rev_comp(seq))
+    return None
+
+def match_starts(buf, mer):
+    "Returns the 0-based starts of all (overlapping) exact matches of bytes `mer` in uint8 array `buf`"
+    n = len(buf) - len(mer) + 1
+    if n <= 0: return np.empty(0, dtype=np.int64)
+    hits = buf[:n] == mer[0]
+    for j in range(1, len(mer)):
+        hits &= buf[j:j+n] == mer[j]
+    return np.flatnonzero(hits)
 
-    # Note: (?=...) is a lookahead assertion matching characters w/o consuming, allowing for overlapping sequences
-    # cmer[::-1] -> rev(cmer)
-    pos = set([1 + c_offset + match.start() for match in re.finditer(f'(?={cmer})',seq)])
-    neg = set([len(cmer) - c_offset + match.start() for match in re.finditer(f'(?={cmer[::-1]})',rev_comp(seq))])
-    if std == 'pos': return pos
-    if std == 'neg': return neg
-    return pos | neg
+def scan_cmers(windows, cmer, c_offset=0, std='both'):
+    """
+    Yields sorted np.int64 arrays of the positions (1-based) of the 'C' in a cmer, one array per window.
+    `windows` is an iterable of successive chunks (str or bytes) of a single sequence, read in any size.
+    The last len(cmer)-1 bases are carried into the next window, so each hit is found exactly once.
+    The (-) strand is scanned as the reverse complement of `cmer` on the (+) strand, so the reverse
+    complement of the sequence is never built. Sequences are matched case-insensitively.
+    """
+    if (usage := check_cmer(cmer, c_offset)): raise ValueError(usage)
+    k = len(cmer)
+    fwd, rev = cmer.encode(), rev_comp(cmer)[::-1].encode()
+    carry, base = b'', 0
+    for chunk in windows:
+        if isinstance(chunk, str): chunk = chunk.encode()
+        seq = carry + bytes(chunk).upper()
+        buf = np.frombuffer(seq, dtype=np.uint8)
+        hits = []
+        if std != 'neg': hits.append(match_starts(buf, fwd) + (base + 1 + c_offset))
+        if std != 'pos': hits.append(match_starts(buf, rev) + (base + k - c_offset))
+        carry = seq[max(0, len(seq) - (k - 1)):]
+        base += len(seq) - len(carry)
+        yield np.sort(np.concatenate(hits))
 
+def find_cmers(seq, cmer, c_offset = 0, std='both'):
+    """
+    Returns a sorted np.int64 array of the positions (1-based) of the 'C' in a cmer of either 'pos', 'neg'
+    or both (default) strands.
+    If the target 'C' is not at start of cmer, then set `c_offset` (default=0)
+    """
+    if (usage := check_cmer(cmer, c_offset)): return usage
+    return np.concatenate(list(scan_cmers([seq], cmer, c_offset, std)))
+
+def fasta_windows(fasta_file, chr=None, window=1 << 24) -> Iterator[tuple[str, bytes]]:
+    """
+    Yields (chrom, chunk) with chunks of about `window` bases, read with the `.fai` index so memory is
+    bounded by `window`. Successive chunks of the same chrom are contiguous. If `chr` is given, only
+    that chrom is yielded.
+    """
+    index, mm = fasta_index(fasta_file), _fasta_mmap(fasta_file)
+    for name in ([chr] if chr is not None else index):
+        if name not in index: continue
+        length, offset, linebases, linewidth = index[name]
+        if length and not linebases:
+            seq = _read_irregular(mm, offset)
+            for start in range(0, length, window): yield name, seq[start:start + window]
+            continue
+        step = max(1, window // max(linebases, 1)) * max(linebases, 1)
+        for start in range(0, length, step):
+            yield name, _read_bases(mm, length, offset, linebases, linewidth, start, start + step).tobytes()
+
+def cmer_cache_dir(fasta_file) -> Path:
+    "Returns `reference/cmers/` for a FASTA in `reference/fasta/`, otherwise a `cmers/` dir beside the FASTA"
+    fasta_dir = Path(fasta_file).resolve().parent
+    return fasta_dir.parent/'cmers' if fasta_dir.name == 'fasta' else fasta_dir/'cmers'
+
+def fasta_checksum(fasta_file) -> str:
+    "Short checksum of the size, mtime and `.fai` index of `fasta_file`, used to key cached positions"
+    index = fasta_index(fasta_file)
+    stat = Path(fasta_file).stat()
+    return hashlib.sha1(f'{stat.st_size}:{stat.st_mtime_ns}:{sorted(index.items())}'.encode()).hexdigest()[:16]
+
+def cached_cmers(fasta_file, chr, cmer, c_offset=0, std='both', window=1 << 24) -> np.ndarray:
+    """
+    Returns the positions of `cmer` on `chr` as in `find_cmers`, memory-mapped from a `.npy` cache.
+    The cache lives in `cmer_cache_dir(fasta_file)/<fasta stem>/<fasta_checksum>/`, so a changed FASTA is
+    never served stale positions; caches for previous checksums of the same FASTA are removed.
+    If the cache cannot be read or written, a warning is printed and the positions are computed uncached.
+    """
+    std = std if std in ('pos', 'neg') else 'both'
+    fasta_dir = cmer_cache_dir(fasta_file)/Path(fasta_file).stem
+    try:
+        cache_dir = fasta_dir/fasta_checksum(fasta_file)
+        path = cache_dir/f'{chr}.{cmer}.{c_offset}.{std}.npy'
+        if path.exists(): return np.load(path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not use the cmer position cache of {fasta_file}: {e}")
+        cache_dir = None
+    positions = next(find_cmers_fasta(fasta_file, cmer, c_offset, std, chr, window, cache=False), (chr, None))[1]
+    if positions is None: positions = np.empty(0, dtype=np.int64)
+    if cache_dir is None: return positions
+    try:
+        for stale in fasta_dir.glob('*'):
+            if stale != cache_dir: shutil.rmtree(stale)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+        with tmp.open('wb') as fh: np.save(fh, positions)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Warning: Could not cache cmer positions in {cache_dir}: {e}")
+        return positions
+    return np.load(path, mmap_mode='r')
+
+def find_cmers_fasta(fasta_file, cmer, c_offset=0, std='both', chr=None, window=1 << 24, cache=True) -> Iterator[tuple[str, np.ndarray]]:
+    """
+    Yields (chrom, positions) for each chromosome of `fasta_file` (or only `chr`), where positions are as in `find_cmers`.
+    With `cache` (default), positions are served from and saved to the cache of `cached_cmers`.
+    Otherwise the FASTA is streamed in windows of `window` bases, so memory is bounded by the window and the hits.
+    """
+    if cache:
+        if (usage := check_cmer(cmer, c_offset)): raise ValueError(usage)
+        index = fasta_index(fasta_file)
+        for chrom in ([chr] if chr is not None else index):
+            if chrom in index: yield chrom, cached_cmers(fasta_file, chrom, cmer, c_offset, std, window)
+        return
+    for chrom, chunks in groupby(fasta_windows(fasta_file, chr, window), key=itemgetter(0)):
+        yield chrom, np.concatenate(list(scan_cmers((chunk for _, chunk in chunks), cmer, c_offset, std)))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Returns positions of cmers positive, negative or both strands')
@@ -72,10 +280,24 @@ if __name__ == '__main__':
     parser.add_argument('--c_offset', type=int, default=0, help='0-base Offset value for C position (default: 0)')
     parser.add_argument('--std', type=str, default='Both', help='Find cmers on pos, neg or both strands. (default: both)')
     parser.add_argument('--chr', type=str, default=None, help='Specify chromosome header to match (default: None)')
+    parser.add_argument('--out', type=str, default=None, help='Save positions to this .npy file instead of printing (default: None)')
+    parser.add_argument('--no_cache', action='store_true', help='Do not read or write the cmer position cache')
     args = parser.parse_args()
 
     fasta_file, cmer, c_offset, std, chr = args.fasta_file, args.cmer, args.c_offset, args.std, args.chr
-    sequence = fasta2seq(fasta_file, chr)
-    if sequence is not None:
-        for position in sorted(find_cmers(sequence, cmer, c_offset, std)):
-            print(position)
+    if (usage := check_cmer(cmer, c_offset)):
+        print(usage)
+        sys.exit(1)
+    # Check before scanning, so no chromosome is searched or cached when the request is ambiguous
+    if chr is None and len(fasta_index(fasta_file)) > 1:
+        print("Error: Multiple sections found in the FASTA file; please specify a chromosome header with --chr.")
+        sys.exit(1)
+    positions = None
+    for chrom, hits in find_cmers_fasta(fasta_file, cmer, c_offset, std.lower(), chr, cache=not args.no_cache):
+        positions = hits
+    if positions is None:
+        print(f"Error: No sequence found matching chr: {chr}")
+    elif args.out:
+        np.save(args.out, positions)
+    else:
+        np.savetxt(sys.stdout, positions, fmt='%d')
@@ -1,42 +1,70 @@
 # Pandas Implementation (See humans2.py for polars Implementation)
+import os, pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from fnames import *
+import site_table
 
 
-def _classify_motif(motif):
-   if motif.startswith('CG'): return 'CG'
-   elif motif[0] == 'C' and motif[2] == 'G': return 'CHG'
-   elif motif[0] == 'C' and motif[1] != 'G' and motif[2] != 'G': return 'CHH'
-   else:return 'Other'
+def motif_type(motif: pd.Series) -> pd.Series:
+    """
+    Classify motifs as CG, CHG, CHH or Other with vectorized string operations (no per-row Python).
+    CG: starts with 'CG'; CHG: 'C' with 'G' third; CHH: any other 'C' motif longer than 2; else Other.
+    Missing motifs stay missing. Matches `human2.motif_type_expr`.
+    """
+    c = motif.str.startswith('C', na=False)
+    third = motif.str[2].fillna('') == 'G'
+    longer = motif.str.len().fillna(0) > 2
+    types = np.select([motif.str.startswith('CG', na=False), c & third, c & longer],
+                      ['CG', 'CHG', 'CHH'], 'Other').astype(object)
+    return pd.Series(types, index=motif.index).where(motif.notna())
 
 
 def read_human_tsv(fn: str| Path) -> pd.DataFrame:
+   df = pd.read_csv(fn, sep='\t', low_memory=False)
+   return _human_df(df)
 
 
-   df = pd.read_csv(fn, sep='\t', low_memory=False)
-   return (df.loc[lambda x: x['Chrom'].str.match(r'^\d+$|^X$|^Y$', na=False)]
+def read_site_table(path: str | Path, samples=None, chroms=None, start=None, end=None) -> pd.DataFrame:
+    """
+    Read a site table dataset written by `site_table.tsv2site_table`, returning the same frame as `read_human_tsv`.
+    Only the partitions for `samples` and `chroms` and the row groups overlapping start <= Pos < end are read.
+    """
+    df = (site_table.read_site_table(path, samples, chroms, start, end).to_pandas()
+          .astype({'Pos': 'int64', 'Converted': 'int64', 'Unconverted': 'int64', 'Depth': 'int64',
+                   'Strand': 'str', 'Motif': 'str'}))
+    return _human_df(df)
+
+
+def _human_df(df: pd.DataFrame) -> pd.DataFrame:
+   return (df.loc[lambda x: x['Chrom'].astype(str).str.match(r'^\d+$|^X$|^Y$', na=False)]
               .astype({'Chrom': 'category'})
               .assign(Chrom=lambda x: x['Chrom']
                       .cat.set_categories([str(i) for i in range(1, 23)] + ['X', 'Y'], ordered=True))
-              .assign(Motif_type=lambda x: x['Motif'].apply(_classify_motif)))
+              .assign(Motif_type=lambda x: motif_type(x['Motif'])))
 
-def human_sort_df(df: pd.DataFrame) -> pd.DataFrame:
+def human_sort_df(df: pd.DataFrame, offsets: dict | None = None) -> pd.DataFrame:
     """
     Sort and transform human genomic DataFrame for continuous genome-wide visualization.
     This function is specifically designed for human genomic data. It:
     1. Calculates new 'Pos' values to be continuous across all chromosomes.
     2. Adds 'Pos_chrom' column, containing original positions.
+    Each run of rows with the same 'Chrom' starts after the largest 'Pos' seen so far. Given chr `offsets`
+    (see reference.chr_offsets and get_chr_len), 'Pos' is instead offsets[Chrom] + 'Pos_chrom'.
     """
     df['Pos_chrom'] = df['Pos'].copy()
-    tpos_max = 0
-    current_chrom = None
-    new_pos = []
-    for chrom, pos in zip(df["Chrom"], df["Pos_chrom"]):
-        if chrom != current_chrom:
-            current_chrom = chrom
-            tpos_max = max(tpos_max, max(new_pos) if new_pos else 0)
-        new_pos.append(tpos_max + pos)
-    df["Pos"] = new_pos
+    if offsets is not None:
+        offset = df['Chrom'].astype(object).map(offsets)
+        if offset.isna().any():
+            raise ValueError(f"Chrom missing from offsets: {sorted(set(df['Chrom'][offset.isna()].astype(str)))}")
+        df['Pos'] = offset.astype('int64') + df['Pos_chrom']
+        return df
+    block = df['Chrom'].ne(df['Chrom'].shift()).cumsum().to_numpy()
+    block_max = df['Pos_chrom'].groupby(block).max().clip(lower=0).to_numpy()
+    offset = np.concatenate([[0], np.cumsum(block_max)[:-1]]).astype('int64')
+    df['Pos'] = offset[block - 1] + df['Pos_chrom'].to_numpy()
     return df
 
 def human_conv_unconv_df(df,depth=1):
@@ -55,15 +83,26 @@ def human_motif_df(df, depth=1):
            .agg({'Ratio_conv': 'mean', 'Ratio_unconv': 'mean'})
            .reset_index())
 
-def human_concat_dfs(in_path, samples, function_df, suffix='tsv.gz'):
-    fn = fname(in_path, samples[0],suffix)
-    df = read_human_tsv(fn)
-    dfs = function_df(df)
-    if len(samples) == 1: return dfs
-    for sample in samples[1:]:
-        fn = fname(in_path, sample, suffix)
-        df = read_human_tsv(fn)
-        df = function_df(df)
-        dfs = pd.concat([dfs,df],ignore_index=True)
-    return(dfs)
+def _human_sample_df(fn, function_df):
+    return function_df(read_human_tsv(fn))
+
 
+def human_concat_dfs(in_path, samples, function_df, suffix='tsv.gz', workers=1):
+    """
+    Apply `function_df` to each sample's site table and concatenate the results once, in `samples` order.
+    By default samples are read one at a time. With `workers` > 1 (None: up to the CPU count) they are read
+    in parallel by a process pool, holding up to `workers` site tables in memory at once; a `function_df`
+    that can't be pickled (a lambda or closure) falls back to the serial path.
+    """
+    fns = [fname(in_path, sample, suffix) for sample in samples]
+    workers = min(len(fns), workers or os.cpu_count())
+    if workers > 1:
+        try: pickle.dumps(function_df)
+        except (pickle.PicklingError, AttributeError, TypeError): workers = 1
+    if workers <= 1:
+        dfs = [_human_sample_df(fn, function_df) for fn in fns]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            dfs = list(pool.map(_human_sample_df, fns, [function_df] * len(fns)))
+    if len(dfs) == 1: return dfs[0]
+    return pd.concat(dfs, ignore_index=True)
@@ -1,57 +1,123 @@
 ### Polars Implemantation of human.py
 
+import resource, sys, time
+from concurrent.futures import ThreadPoolExecutor
 import polars as pl
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 from fnames import *
+import site_table
 
-def pl2pd(polars_df: pl.DataFrame, chunk_size: int = 10_000_000) -> pd.DataFrame | None:
+def pl2pd(polars_df: pl.DataFrame, arrow_dtypes: bool = False, verbose: bool = False) -> pd.DataFrame | None:
     """
-    Convert a Polars DataFrame to a pandas DataFrame in chunks.
+    Convert a Polars DataFrame to a pandas DataFrame through Arrow, handing over column buffers
+    without creating per-row Python objects.
+    `arrow_dtypes`: keep pandas ArrowDtype columns, so strings are not copied into Python objects.
+    Enum columns (e.g. 'Chrom') become ordered Categoricals with the same categories.
+    `verbose`: print the time taken and peak memory (Arrow memory pool and process max RSS).
     Returns: The converted pandas DataFrame, or None if conversion fails.
-    Useful for large datatrames
     """
-    total_rows = polars_df.shape[0]
-    pandas_dfs = []
+    start, rss = time.perf_counter(), _max_rss_mb()
     try:
-        for i in range(0, total_rows, chunk_size):
-            chunk = polars_df.slice(i, chunk_size)
-            pandas_chunk = pd.DataFrame(chunk.to_dicts())
-            pandas_dfs.append(pandas_chunk)
-
-        return pd.concat(pandas_dfs, ignore_index=True)
+        df = polars_df.to_pandas(use_pyarrow_extension_array=arrow_dtypes)
+        for col, dtype in polars_df.schema.items():
+            if isinstance(dtype, pl.Enum):
+                codes = polars_df[col].to_physical().fill_null(-1).to_numpy()
+                df[col] = pd.Categorical.from_codes(codes, categories=dtype.categories.to_list(), ordered=True)
     except Exception as e:
         print(f"Error during conversion: {e}")
         return None
+    if verbose:
+        print(f"pl2pd: {len(df):,} rows in {time.perf_counter() - start:.2f}s, "
+              f"Arrow pool peak {pa.default_memory_pool().max_memory() / 1e6:,.0f} MB, "
+              f"peak RSS {_max_rss_mb():,.0f} MB (+{_max_rss_mb() - rss:,.0f} MB)")
+    return df
+
+
+def _max_rss_mb() -> float:
+    "Peak resident memory of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3
+
+
+def motif_type_expr(col: str = 'Motif') -> pl.Expr:
+    """
+    Classify motifs as CG, CHG, CHH or Other with native string expressions (no per-row Python).
+    CG: starts with 'CG'; CHG: 'C' with 'G' third; CHH: any other 'C' motif longer than 2; else Other.
+    Null motifs stay null.
+    """
+    motif = pl.col(col)
+    c = motif.str.starts_with('C')
+    return (pl.when(motif.is_null()).then(None)
+              .when(motif.str.starts_with('CG')).then(pl.lit('CG'))
+              .when(c & (motif.str.slice(2, 1) == 'G')).then(pl.lit('CHG'))
+              .when(c & (motif.str.len_chars() > 2)).then(pl.lit('CHH'))
+              .otherwise(pl.lit('Other')))
+
+
+chrom_categories = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+
+
+def scan_human(fn: str | Path, chroms: list[str] | None = None, depth: int | None = None,
+               columns: list[str] | None = None) -> pl.LazyFrame:
+    """
+    Lazily scan a site table: `scan_csv` for .tsv/.tsv.gz, otherwise `scan_parquet`.
+    Nothing is read until the frame is collected; the `chroms` filter (default: `chrom_categories`),
+    the `Depth >= depth` threshold and the `columns` projection are pushed down into the scan.
+    Chrom is an Enum of `chrom_categories` and Motif_type is added if missing.
+    """
+    if '.tsv' in Path(fn).name:
+        lf = pl.scan_csv(fn, separator='\t',
+                         schema_overrides={
+                             'Chrom': pl.Utf8,
+                             'Ratio_conv': pl.Float64,
+                             'Ratio_unconv': pl.Float64})
+    else:
+        lf = pl.scan_parquet(fn)
+    return _human_lazy(lf, chroms, depth, columns)
+
+
+def scan_site_table(path: str | Path, samples: list[str] | None = None, chroms: list[str] | None = None,
+                    start: int | None = None, end: int | None = None, depth: int | None = None,
+                    columns: list[str] | None = None) -> pl.LazyFrame:
+    """
+    Lazily scan a site table dataset written by `site_table.tsv2site_table`, returning the same frame as `scan_human`.
+    `samples` and `chroms` prune hive partitions and start <= Pos < end prunes row groups by their Pos statistics.
+    Rows come grouped by partition (Sample, then Chrom in path order); sort before `human_sort_df`.
+    """
+    lf = pl.scan_parquet(Path(path), hive_partitioning=True, hive_schema={'Sample': pl.Utf8, 'Chrom': pl.Utf8})
+    if samples is not None: lf = lf.filter(pl.col('Sample').is_in([str(s) for s in samples]))
+    if start is not None: lf = lf.filter(pl.col('Pos') >= start)
+    if end is not None: lf = lf.filter(pl.col('Pos') < end)
+    lf = (lf.with_columns(pl.col('Pos', 'Converted', 'Unconverted', 'Depth').cast(pl.Int64),
+                          pl.col('Strand', 'Motif').cast(pl.Utf8))
+            .select(site_table.COLUMNS))
+    return _human_lazy(lf, chroms, depth, columns)
+
+
+def _human_lazy(lf: pl.LazyFrame, chroms, depth, columns) -> pl.LazyFrame:
+    chroms = chrom_categories if chroms is None else [str(c) for c in chroms]
+    lf = lf.filter(pl.col('Chrom').cast(pl.Utf8).is_in(chroms))
+    if depth is not None: lf = lf.filter(pl.col('Depth') >= depth)
+    lf = lf.with_columns(pl.col('Chrom').cast(pl.Utf8).cast(pl.Enum(chrom_categories)))
+    if 'Motif_type' not in lf.collect_schema().names():
+        lf = lf.with_columns(Motif_type=motif_type_expr())
+    return lf.select(columns) if columns else lf
+
+
+def scan_human_samples(in_path, samples, suffix='pq', **kwargs) -> pl.LazyFrame:
+    "Lazy concatenation of `scan_human` over `samples`; `kwargs` are passed to `scan_human`"
+    return pl.concat([scan_human(fname(in_path, sample, suffix), **kwargs) for sample in samples])
 
 
 # Includes Categorical Data for Chromosomes Sorting
 def read_human_tsv(fn: str| Path) -> pl.DataFrame:
-    def classify_motif(motif: str) -> str:
-        if motif.startswith('CG'): return 'CG'
-        elif motif.startswith('C') and len(motif) > 2 and motif[2] == 'G': return 'CHG'
-        elif (motif.startswith('C') and len(motif) > 2 and motif[1] != 'G' and motif[2] != 'G'): return 'CHH'
-        else:return 'Other'
-    chrom_categories = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
-    return (pl.read_csv(fn, separator='\t',
-            schema_overrides={
-                'Chrom': pl.Utf8,
-                'Ratio_conv': pl.Float64,
-                'Ratio_unconv': pl.Float64})
-        .filter(pl.col('Chrom').is_in(chrom_categories))
-        .with_columns(
-            pl.col('Chrom').cast(pl.Enum(chrom_categories)),
-             Motif_type=pl.col('Motif').map_elements(classify_motif, return_dtype=pl.Utf8)))
+    return scan_human(fn).collect()
 
 
 # Excludes Categorical Data for Chromosomes Sorting
 # def read_human_tsv(fn: str| Path) -> pl.DataFrame:
-#     def classify_motif(motif: str) -> str:
-#         if motif.startswith('CG'): return 'CG'
-#         elif motif.startswith('C') and len(motif) > 2 and motif[2] == 'G': return 'CHG'
-#         elif (motif.startswith('C') and len(motif) > 2 and motif[1] != 'G' and motif[2] != 'G'): return 'CHH'
-#         else:return 'Other'
-
 #     chrom_categories = [str(i) for i in range(1, 23)] + ['X', 'Y']
 #     return (pl.read_csv(fn, separator='\t',
 #             schema_overrides={
@@ -59,9 +125,9 @@ def read_human_tsv(fn: str| Path) -> pl.DataFrame:
 #                 'Ratio_conv': pl.Float64,
 #                 'Ratio_unconv': pl.Float64})
 #         .filter(pl.col('Chrom').is_in(chrom_categories))
-#         .with_columns(Motif_type=pl.col('Motif').map_elements(classify_motif, return_dtype=pl.Utf8)))
+#         .with_columns(Motif_type=motif_type_expr()))
 
-def human_conv_unconv_df(df: pl.DataFrame, depth: int = 1) -> pl.DataFrame:
+def human_conv_unconv_df(df: pl.DataFrame | pl.LazyFrame, depth: int = 1) -> pl.DataFrame | pl.LazyFrame:
     return (df.filter(pl.col('Depth') >= depth)
               .group_by('Sample',maintain_order=True)
               .agg([pl.sum('Converted').alias('Converted'),
@@ -73,7 +139,7 @@ def human_conv_unconv_df(df: pl.DataFrame, depth: int = 1) -> pl.DataFrame:
               .select(['Sample', 'Ratio_conv', 'Ratio_unconv']))
 
 
-def human_motif_df(df: pl.DataFrame, depth: int = 1) -> pl.DataFrame:
+def human_motif_df(df: pl.DataFrame | pl.LazyFrame, depth: int = 1) -> pl.DataFrame | pl.LazyFrame:
     return (df.filter(pl.col('Depth') >= depth)
               .group_by(['Sample', 'Motif_type'],maintain_order=True)
               .agg([pl.sum('Converted').alias('Converted'),
@@ -85,26 +151,50 @@ def human_motif_df(df: pl.DataFrame, depth: int = 1) -> pl.DataFrame:
               .select(['Sample','Depth', 'Motif_type', 'Ratio_conv', 'Ratio_unconv']))
 
 
-def human_sort_df(df: pl.DataFrame) -> pl.DataFrame:
+def human_sort_df(df: pl.DataFrame, offsets: dict | None = None) -> pl.DataFrame:
+    """
+    Continuous genome-wide 'Pos' for plotting, keeping the original positions in 'Pos_chrom'.
+    Each run of rows with the same 'Chrom' starts after the largest 'Pos' seen so far. Given chr `offsets`
+    (see reference.chr_offsets and get_chr_len), 'Pos' is instead offsets[Chrom] + 'Pos_chrom'.
+    """
     df = df.with_columns(pl.col('Pos').alias('Pos_chrom'))
-    tpos_max, current_chrom, new_pos = 0, None, []
-    for chrom, pos in zip(df["Chrom"].to_list(), df["Pos_chrom"].to_list()):
-        if chrom != current_chrom:
-            current_chrom = chrom
-            tpos_max = max(tpos_max, max(new_pos) if new_pos else 0)
-        new_pos.append(tpos_max + pos)
-    return df.with_columns(pl.Series(new_pos).alias('Pos'))
-
-
-def human_concat_dfs(in_path, samples, function_df, suffix='pq') -> pl.DataFrame:
-    fn = fname(in_path, samples[0],suffix)
-    df = read_human_tsv(fn) if suffix == 'tsv.gz' else pl.read_parquet(fn)
-    dfs = function_df(df)
-    if len(samples) == 1: return dfs
-    for sample in samples[1:]:
+    if offsets is not None:
+        offset = pl.col('Chrom').cast(pl.Utf8).replace_strict(offsets, return_dtype=pl.Int64)
+        return df.with_columns((offset + pl.col('Pos_chrom')).alias('Pos'))
+    df = df.with_columns(pl.col('Chrom').ne_missing(pl.col('Chrom').shift()).cum_sum().alias('_block'))
+    offsets = (df.group_by('_block', maintain_order=True)
+                 .agg(pl.col('Pos_chrom').max().clip(lower_bound=0).cast(pl.Int64).alias('_offset'))
+                 .with_columns(pl.col('_offset').cum_sum().shift(1, fill_value=0)))
+    return (df.join(offsets, on='_block', how='left', maintain_order='left')
+              .with_columns((pl.col('_offset') + pl.col('Pos_chrom')).alias('Pos'))
+              .drop('_block', '_offset'))
+
+
+def human_concat_dfs(in_path, samples, function_df, suffix='pq', workers=4) -> pl.DataFrame:
+    """
+    Apply `function_df` to each sample's site table and concatenate the results once, in `samples` order.
+    Samples are read by `workers` threads; Polars releases the GIL while reading and aggregating, so samples
+    proceed in parallel. Each thread holds a full site table, so peak memory is about `workers` tables:
+    keep `workers` small for large genomes (Polars already uses every core within one read). `workers=1` runs serially.
+    """
+    def sample_df(sample):
         fn = fname(in_path, sample, suffix)
-        df = read_human_tsv(fn) if suffix == 'tsv.gz' else pl.read_parquet(fn)
-        df = function_df(df)
-        dfs = pl.concat([dfs, df])
-    return dfs
+        return function_df(read_human_tsv(fn) if suffix == 'tsv.gz' else pl.read_parquet(fn))
+
+    if workers == 1:
+        dfs = [sample_df(sample) for sample in samples]
+    else:
+        with ThreadPoolExecutor(min(workers or 4, len(samples))) as pool:
+            dfs = list(pool.map(sample_df, samples))
+    if len(dfs) == 1: return dfs[0]
+    return pl.concat(dfs)
 
+
+def human_lazy_dfs(in_path, samples, function_df, suffix='pq', chroms=None, depth=None) -> pl.DataFrame:
+    """
+    Run `function_df` (e.g. `human_conv_unconv_df`, `human_motif_df`) as one lazy query over all `samples`
+    and collect it with the streaming engine, so peak memory is bounded by the aggregation rather than
+    the site tables. Returns the same frame as `human_concat_dfs`.
+    """
+    lf = scan_human_samples(in_path, samples, suffix, chroms=chroms, depth=depth)
+    return function_df(lf).collect(engine='streaming')
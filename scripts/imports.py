@@ -7,3 +7,6 @@ from find_cmers import *
 from motif import *
 from merge_sample_fname import *
 from human2 import *
+from site_table import *
+from site_index import *
+from pyramid import *
@@ -5,8 +5,9 @@
 # single file for downstream processing
 
 from pathlib import Path
-import re, os, subprocess
-from typing import Dict, List, Union
+import re, os, shutil, subprocess, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple, Union
 import argparse
 
 def map_run(run_dir: Union[str, Path]) -> Dict[str, str]:
@@ -56,7 +57,60 @@ def map_all_runs(*run_dirs: Union[str, Path]) -> Dict[str, List[str]]:
                 matched_files[key].append(str(Path(run_dir) / result[key]))
     return matched_files
 
-def merge_runs(out_dir: Union[str, Path], *run_dirs: Union[str, Path], compress: bool = True) -> None:
+def concat_gz(files: List[str], output_file: Path) -> None:
+    """
+    Concatenate gzip files byte for byte into `output_file` without decompressing.
+    A gzip file may contain multiple members, so the result is a valid gzip of the concatenated FASTQs.
+    """
+    with output_file.open('wb') as outfile:
+        for file in files:
+            with open(file, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, 1 << 24)
+
+def recompress_gz(files: List[str], output_file: Path, threads: Optional[int] = None) -> None:
+    """
+    Decompress `files` (validating each gzip) and pipe them straight into pigz, writing a single-member
+    gzip `output_file` without an uncompressed temporary file. `threads` are pigz threads (default: all cores).
+    """
+    with output_file.open('wb') as outfile:
+        pigz = subprocess.Popen(['pigz', '-c'] + (['-p', str(threads)] if threads else []), stdin=subprocess.PIPE, stdout=outfile)
+        try:
+            for file in files:
+                subprocess.run(['gzip', '-dc', file], stdout=pigz.stdin, check=True)
+        finally:
+            pigz.stdin.close()
+            pigz.wait()
+    if pigz.returncode:
+        raise subprocess.CalledProcessError(pigz.returncode, 'pigz')
+
+def merge_key(key: str, file_list: List[str], out_dir: Path, compress: bool = True, mode: str = 'concat',
+              threads: Optional[int] = None) -> Tuple[Path, int, float]:
+    """
+    Merge the `file_list` of one sample_strand `key` into `out_dir`.
+    Output is written to a hidden temporary name and renamed on success, so a crash never leaves a truncated FASTQ.
+    Returns (output file, bytes read, seconds).
+    """
+    start = time.perf_counter()
+    ext = '.'.join(Path(file_list[0]).suffixes[:-1])
+    output_file = out_dir / f"{key}{ext}{'.gz' if compress else ''}"
+    tmp_file = out_dir / f".{output_file.name}.tmp"
+    try:
+        if not compress:
+            with tmp_file.open('wb') as outfile:
+                for file in file_list:
+                    subprocess.run(['zcat', file], stdout=outfile, check=True)
+        elif mode == 'concat':
+            concat_gz(file_list, tmp_file)
+        else:
+            recompress_gz(file_list, tmp_file, threads)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return output_file, sum(os.path.getsize(file) for file in file_list), time.perf_counter() - start
+
+def merge_runs(out_dir: Union[str, Path], *run_dirs: Union[str, Path], compress: bool = True, mode: str = 'concat',
+               jobs: int = 1) -> None:
     """
     Merge files from multiple run directories based on their sample_strand key.
     
@@ -64,39 +118,49 @@ def merge_runs(out_dir: Union[str, Path], *run_dirs: Union[str, Path], compress:
     out_dir (Union[str, Path]): The output directory for merged files.
     *run_dirs: Variable number of input run directory paths.
     compress (bool): Whether to compress the output files (default: True).
+    mode (str): How compressed output is written (default: 'concat').
+        'concat': concatenate the gzip files as is, with no decompression (see concat_gz)
+        'recompress': validate and recompress the data into a single gzip member with pigz (see recompress_gz)
+    jobs (int): Number of keys merged concurrently (default: 1). 'concat' is bound by disk I/O, so a few jobs
+        are usually enough; with 'recompress' the cores are split between the jobs' pigz processes.
     
     Raises:
     FileExistsError: If the output directory already exists.
+    ValueError: If mode is not 'concat' or 'recompress'.
     
     Returns:
     None
     """
+    if mode not in ('concat', 'recompress'):
+        raise ValueError(f"mode must be 'concat' or 'recompress', not '{mode}'")
     out_dir = Path(out_dir)
     if out_dir.exists():
         raise FileExistsError(f"The '{out_dir}' directory already exists.")
     out_dir.mkdir()
-    matched_files = map_all_runs(*run_dirs)
-    for key, file_list in matched_files.items():
-        if file_list:
-            ext = '.'.join(Path(file_list[0]).suffixes[:-1])
-            output_file = out_dir / f"{key}{ext}"
-            with output_file.open('wb') as outfile:
-                for file in file_list:
-                    subprocess.run(['zcat', file], stdout=outfile, check=True)
-            if compress:
-                compressed_file = output_file.with_suffix(output_file.suffix + '.gz')
-                subprocess.run(['pigz', '-c', output_file], stdout=compressed_file.open('wb'), check=True)
-                output_file.unlink()
-                print(f"Merged and compressed: {compressed_file}")
-            else:
-                print(f"Merged: {output_file}")
-    print(f"Files merged successfully in the '{out_dir}' directory.")
+    matched_files = {key: file_list for key, file_list in map_all_runs(*run_dirs).items() if file_list}
+    jobs = max(1, min(jobs, len(matched_files)))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    start, total = time.perf_counter(), 0
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(merge_key, key, file_list, out_dir, compress, mode, threads)
+                   for key, file_list in matched_files.items()]
+        for future in as_completed(futures):
+            output_file, size, seconds = future.result()
+            total += size
+            print(f"{'Merged and compressed' if compress else 'Merged'}: {output_file} "
+                  f"({size / 1e6:.1f} MB, {size / 1e6 / max(seconds, 1e-9):.1f} MB/s)")
+    seconds = time.perf_counter() - start
+    print(f"Files merged successfully in the '{out_dir}' directory: "
+          f"{total / 1e6:.1f} MB in {seconds:.1f} s ({total / 1e6 / max(seconds, 1e-9):.1f} MB/s)")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge sequencing run files across multiple directories.")
     parser.add_argument("out_dir", type=str, help="Output directory for merged files")
     parser.add_argument("run_dirs", nargs="+", type=str, help="Input run directories")
     parser.add_argument("--no-compress", action="store_true", help="Do not compress output files")
+    parser.add_argument("--mode", choices=["concat", "recompress"], default="concat",
+                        help="concat: join gzip files without decompressing; recompress: validate and recompress with pigz (default: concat)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of sample_strand keys merged concurrently (default: 1)")
     args = parser.parse_args()
 
-    merge_runs(args.out_dir, *args.run_dirs, compress=not args.no_compress)
+    merge_runs(args.out_dir, *args.run_dirs, compress=not args.no_compress, mode=args.mode, jobs=args.jobs)
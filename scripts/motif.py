@@ -6,10 +6,17 @@
 # Based on code by Chang Ye: https://github.com/y9c/variant
 
 import argparse, os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 from pysam import FastaFile
 from xopen import xopen
 from seqpy import revcomp
 
+# Complement table matching `seq_comp_table` in seqpy.c, so batched output is byte-identical to `revcomp`
+_comp = np.frombuffer(bytes.maketrans(b'ABCDGHKMRTUVYabcdghkmrtuvy`', b'TVGHCDMKYAABRtvghcdmkyaabr@'), dtype=np.uint8)
+
 def find_motif(fasta_idx: FastaFile, chrom: str, pos: int, strand: str, motif_len: int) -> str:
     """
     Takes a 'fasta_idx: FastaFile' and returns a 'motif', keyed by ['chrom', 'pos', 'strand']
@@ -56,6 +63,143 @@ def append_motif(in_tsv: str, out_tsv: str, fasta_reference: str, motif_len=3, f
             print(f"{line}\t{motif}", file=out_stream)
     return(True)
 
+def chrom_seq(fasta_idx: FastaFile, chrom: str, cache: dict) -> np.ndarray | None:
+    """
+    Returns the full sequence of 'chrom' as a uint8 array, or None if 'chrom' is not in 'fasta_idx'
+    Only the most recent chromosome is kept in 'cache', which suffices for input sorted by chromosome
+    """
+    if chrom not in cache:
+        cache.clear()
+        try:
+            cache[chrom] = np.frombuffer(fasta_idx.fetch(chrom).encode(), dtype=np.uint8)
+        except (ValueError, KeyError):
+            cache[chrom] = None
+    return cache[chrom]
+
+def region_seq(fasta_idx: FastaFile, chrom: str, pos: np.ndarray, minus: np.ndarray, motif_len: int) -> tuple:
+    """
+    Returns ('seq', 'offset') for only the span of 'chrom' covering the sites, or (None, 0) if 'chrom' is not in 'fasta_idx'
+    Bounds memory to the chunk rather than the chromosome, for use by parallel workers
+    """
+    starts = np.where(minus, pos - motif_len, pos - 1)
+    starts = starts[starts >= 0]
+    if not len(starts): return np.empty(0, dtype=np.uint8), 0
+    start, end = int(starts.min()), int(starts.max()) + motif_len
+    try:
+        return np.frombuffer(fasta_idx.fetch(chrom, start, end).encode(), dtype=np.uint8), start
+    except (ValueError, KeyError):
+        return None, 0
+
+def find_motifs(seq: np.ndarray | None, pos: np.ndarray, minus: np.ndarray, motif_len: int, offset=0) -> list[str]:
+    """
+    Vectorized 'find_motif' for all sites on one chromosome 'seq', keyed by 1-based 'pos' and boolean 'minus' strand
+    Matches 'FastaFile.fetch': a start < 0 returns 'N' * motif_len and motifs are truncated at the chromosome end
+    'offset' is the 0-based chromosome position of 'seq[0]' when 'seq' is a region (see 'region_seq')
+    """
+    if seq is None: return ["N" * motif_len] * len(pos)
+    starts = np.where(minus, pos - motif_len, pos - 1)
+    full = (starts >= 0) & (starts - offset + motif_len <= len(seq))
+    starts = starts - offset
+    motifs = np.zeros(len(pos), dtype=f'S{max(motif_len, 1)}')
+    if full.any() and motif_len:
+        mers = seq[starts[full, None] + np.arange(motif_len)]
+        rc = minus[full]
+        mers[rc] = _comp[mers[rc, ::-1]]
+        motifs[full] = np.ascontiguousarray(mers).view(motifs.dtype).ravel()
+    motifs = motifs.astype(str).tolist()
+    for i in np.flatnonzero(~full):
+        start = int(starts[i])
+        if start + offset < 0: motifs[i] = "N" * motif_len
+        else:
+            motif = seq[start:start+motif_len].tobytes().decode()
+            motifs[i] = revcomp(motif) if minus[i] else motif
+    return motifs
+
+def annotate_lines(lines: list[str], fasta_idx: FastaFile, cache: dict | None, motif_len: int, idxs: list[int]) -> str:
+    """
+    Returns a block of 'lines' with a 'Motif' field appended, grouping sites by chromosome
+    'idxs' are 0-based positions of the fields 'chrom','pos','strand'
+    If 'cache' is None, only the region spanned by the sites is fetched (see 'region_seq')
+    """
+    chrom_idx, pos_idx, strand_idx = idxs
+    lines = [line.strip() for line in lines]
+    rows = [line.split('\t') for line in lines]
+    groups = {}
+    for i, fields in enumerate(rows): groups.setdefault(fields[chrom_idx], []).append(i)
+    motifs = [None] * len(lines)
+    for chrom, rows_idx in groups.items():
+        pos = np.array([int(rows[i][pos_idx]) for i in rows_idx], dtype=np.int64)
+        minus = np.array([rows[i][strand_idx] != '+' for i in rows_idx], dtype=bool)
+        if cache is None: seq, offset = region_seq(fasta_idx, chrom, pos, minus, motif_len)
+        else: seq, offset = chrom_seq(fasta_idx, chrom, cache), 0
+        for i, motif in zip(rows_idx, find_motifs(seq, pos, minus, motif_len, offset)):
+            motifs[i] = motif
+    return ''.join([f"{line}\t{motif}\n" for line, motif in zip(lines, motifs)])
+
+def append_motif_batch(in_tsv: str, out_tsv: str, fasta_reference: str, motif_len=3, field_idxs=[2,3,4],
+                       chunk_size=1_000_000) -> bool:
+    """
+    Batched 'append_motif' producing identical output, for large (whole-genome) site tables
+        - Reads 'in_tsv' in chunks of 'chunk_size' lines and groups each chunk by chromosome
+        - Each chromosome is loaded once into a contiguous buffer; motifs are extracted by vectorized slicing
+        - Output is written one chunk at a time
+    """
+    if in_tsv == out_tsv:
+        print(f'Warning: {in_tsv} and {out_tsv} are the same file')
+        return(False)
+    idxs = [index - 1 for index in field_idxs] # Convert 1-based indices to 0-based indices
+    cache = {}
+    with xopen(in_tsv) as in_stream, xopen(out_tsv, "w") as out_stream, FastaFile(fasta_reference) as fasta_idx:
+        header = next(in_stream).strip()
+        if 'Motif' in header or 'motif' in header:
+            print(f'Warning: Motif previously appended to {in_tsv}' )
+            os.remove(out_tsv)
+            return(None)
+        print(f"{header}\tMotif", file=out_stream)
+        while lines := list(islice(in_stream, chunk_size)):
+            out_stream.write(annotate_lines(lines, fasta_idx, cache, motif_len, idxs))
+    return(True)
+
+# Per-process state for 'append_motif_parallel' workers, each with its own FastaFile handle
+_worker = {}
+
+def _init_worker(fasta_reference: str, motif_len: int, idxs: list[int]) -> None:
+    _worker.update(fasta_idx=FastaFile(fasta_reference), motif_len=motif_len, idxs=idxs)
+
+def _annotate_chunk(lines: list[str]) -> str:
+    return annotate_lines(lines, _worker['fasta_idx'], None, _worker['motif_len'], _worker['idxs'])
+
+def append_motif_parallel(in_tsv: str, out_tsv: str, fasta_reference: str, motif_len=3, field_idxs=[2,3,4],
+                          chunk_size=200_000, workers=os.cpu_count()) -> bool:
+    """
+    Multi-process 'append_motif' producing identical output
+        - 'in_tsv' is split into chunks of 'chunk_size' lines, each annotated by one of 'workers' processes
+        - Annotated chunks are written back in their original order
+        - At most 2 * 'workers' chunks are in flight and each worker fetches only the region its chunk spans,
+          so memory is bounded by chunk size rather than input or chromosome size
+        - A gz 'out_tsv' is compressed with 'workers' threads
+    """
+    if in_tsv == out_tsv:
+        print(f'Warning: {in_tsv} and {out_tsv} are the same file')
+        return(False)
+    idxs = [index - 1 for index in field_idxs] # Convert 1-based indices to 0-based indices
+    with xopen(in_tsv) as in_stream, xopen(out_tsv, "w", threads=workers) as out_stream, \
+         ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(fasta_reference, motif_len, idxs)) as pool:
+        header = next(in_stream).strip()
+        if 'Motif' in header or 'motif' in header:
+            print(f'Warning: Motif previously appended to {in_tsv}' )
+            os.remove(out_tsv)
+            return(None)
+        print(f"{header}\tMotif", file=out_stream)
+        pending = deque()
+        while lines := list(islice(in_stream, chunk_size)):
+            pending.append(pool.submit(_annotate_chunk, lines))
+            if len(pending) >= 2 * workers:
+                out_stream.write(pending.popleft().result())
+        while pending:
+            out_stream.write(pending.popleft().result())
+    return(True)
+
 def is_gzipped(file):
     with open(file, 'rb') as f: return f.read(2) == b'\x1f\x8b'
 
@@ -73,5 +217,15 @@ if __name__ == "__main__":
     parser.add_argument("--motif_len", type=int, default=3, help="`motif_len` is motif length, starting with each 'C' on (+) or (-) strand, default=3")
     parser.add_argument("--fields", type=lambda x: [int(i) for i in x.split(',')], default=[2,3,4],
                         help="'field_indx' is a comma delimited position list of fields for 'chrom','pos','strand' in 'in_tsv', default=2,3,4")
+    parser.add_argument("--batch", action="store_true", help="Use the batched engine, grouping chunks of sites by chromosome")
+    parser.add_argument("--chunk_size", type=int, default=None, help="Lines per chunk, default=1000000 for --batch, 200000 for --workers")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes; N > 1 annotates chunks in parallel, default=1")
     args = parser.parse_args()
-    append_motif(args.in_tsv, args.out_tsv, args.fasta_reference, args.motif_len, args.fields)
+    # Without --chunk_size each engine keeps its own default
+    chunk = {} if args.chunk_size is None else {'chunk_size': args.chunk_size}
+    if args.workers > 1:
+        append_motif_parallel(args.in_tsv, args.out_tsv, args.fasta_reference, args.motif_len, args.fields, workers=args.workers, **chunk)
+    elif args.batch:
+        append_motif_batch(args.in_tsv, args.out_tsv, args.fasta_reference, args.motif_len, args.fields, **chunk)
+    else:
+        append_motif(args.in_tsv, args.out_tsv, args.fasta_reference, args.motif_len, args.fields)
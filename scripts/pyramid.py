@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Zoom-level pyramid cache for genome-wide plotting
+# Per sample, window sums of Unconverted, Converted and Depth (and site counts) are persisted at several
+# window sizes, one memory-mapped .npy per size and chromosome:
+#     <cache_dir>/<sample>/<size>/<chrom>.npy   records of (Pos, Unconverted, Converted, Depth, Count)
+#     <cache_dir>/<sample>/meta.json            sizes, and per chrom its last Pos and a signature of its site table files
+# Metrics ('unconverted' and 'converted' ratios, mean 'depth') are derived from the sums when read, as in windows.windows_*.
+# Builds are incremental: chromosomes whose site table partitions are unchanged are skipped, and new sizes are
+# aggregated from the finest cached size that divides them. `view` picks the finest size that keeps the number
+# of windows under a limit, so a whole-genome view reads kilobytes. `export_bedgraph` writes tracks for igv-webapp.
+
+import argparse, hashlib, json, os
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import site_table
+from windows import genome_pos, window_levels
+
+PYRAMID_SIZES = (100, 1_000, 10_000, 100_000, 1_000_000)
+PYRAMID_METRICS = ('unconverted', 'converted', 'depth')
+PYRAMID_SUMS = ['Unconverted', 'Converted', 'Depth']
+PYRAMID_DTYPE = np.dtype([('Pos', np.int64), ('Unconverted', np.int64), ('Converted', np.int64),
+                          ('Depth', np.int64), ('Count', np.int64)])
+
+
+def _signature(fragments: List[ds.FileFragment]) -> str:
+    "Checksum of the paths, sizes and mtimes of a chromosome's site table files"
+    stats = [(f.path, os.stat(f.path).st_size, os.stat(f.path).st_mtime_ns) for f in fragments]
+    return hashlib.sha1(repr(sorted(stats)).encode()).hexdigest()
+
+
+def _save(path: Path, records: np.ndarray) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    with open(tmp, 'wb') as fh: np.save(fh, records)
+    os.replace(tmp, path)
+
+
+def _records(level: dict) -> np.ndarray:
+    records = np.empty(len(level['pos']), dtype=PYRAMID_DTYPE)
+    records['Pos'], records['Count'] = level['pos'], level['count']
+    for col in PYRAMID_SUMS: records[col] = level['sums'][col]
+    return records
+
+
+def _levels(pos: np.ndarray, values: Dict[str, np.ndarray], sizes, counts=None) -> Dict[int, np.ndarray]:
+    return {size: _records(level)
+            for size, level in window_levels(np.zeros(len(pos), dtype=np.int64), pos, values, sizes, counts).items()}
+
+
+def build_pyramid(site_dir: Union[str, Path], cache_dir: Union[str, Path], sample: str,
+                  sizes=PYRAMID_SIZES) -> Path:
+    """
+    Build or update the pyramid of `sample` at `sizes` from the site table dataset at `site_dir` (see site_table.py).
+    Only chromosomes whose partitions changed are read (one at a time); sizes missing from an unchanged chromosome
+    are aggregated from its finest cached size that divides them. Returns the sample's cache path.
+    """
+    dataset = site_table.site_dataset(site_dir)
+    path = Path(cache_dir)/str(sample)
+    meta = json.loads((path/'meta.json').read_text()) if (path/'meta.json').exists() else {'sizes': [], 'chroms': {}}
+    fragments = {}
+    for fragment in dataset.get_fragments(filter=ds.field('Sample') == str(sample)):
+        fragments.setdefault(ds.get_partition_keys(fragment.partition_expression)['Chrom'], []).append(fragment)
+    sizes = sorted(set(sizes) | set(meta['sizes']))
+    chroms = {}
+    for chrom, chrom_fragments in sorted(fragments.items()):
+        signature, cached = _signature(chrom_fragments), meta['chroms'].get(chrom, {})
+        if cached.get('signature') == signature:
+            missing = [size for size in sizes if size not in meta['sizes']]
+            for size in missing:
+                finer = max((s for s in meta['sizes'] if size % s == 0), default=None)
+                if finer is None:
+                    cached = {}
+                    break
+                level = np.load(path/str(finer)/f'{chrom}.npy')
+                _save(path/str(size)/f'{chrom}.npy',
+                      _levels(level['Pos'], {col: level[col] for col in PYRAMID_SUMS}, [size], level['Count'])[size])
+            if cached:
+                chroms[chrom] = cached
+                continue
+        table = dataset.to_table(columns=['Pos'] + PYRAMID_SUMS,
+                                 filter=(ds.field('Sample') == str(sample)) & (ds.field('Chrom') == chrom))
+        pos = table['Pos'].to_numpy()
+        for size, records in _levels(pos, {col: table[col].to_numpy() for col in PYRAMID_SUMS}, sizes).items():
+            _save(path/str(size)/f'{chrom}.npy', records)
+        chroms[chrom] = {'signature': signature, 'end': int(pos.max()) if len(pos) else 0}
+    for chrom in set(meta['chroms']) - set(chroms):
+        for size in meta['sizes']: (path/str(size)/f'{chrom}.npy').unlink(missing_ok=True)
+    meta = {'sizes': sizes, 'chroms': chroms}
+    path.mkdir(parents=True, exist_ok=True)
+    tmp = path/'.meta.json.tmp'
+    tmp.write_text(json.dumps(meta))
+    os.replace(tmp, path/'meta.json')
+    return path
+
+
+class Pyramid:
+    """
+    Memory-mapped zoom-level pyramid of one sample (see `build_pyramid`)
+    Example: Pyramid('pyramid/S1').view(metric='converted')  # whole genome at an automatically chosen size
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        meta = json.loads((self.path/'meta.json').read_text())
+        self.sizes, self.chroms = meta['sizes'], meta['chroms']
+        self.sample = self.path.name
+
+    def __repr__(self):
+        return f"Pyramid({str(self.path)!r}, sizes={self.sizes}, chroms={len(self.chroms)})"
+
+    def level(self, size: int, chrom: str) -> np.ndarray:
+        "Window records of `chrom` at `size`, memory-mapped"
+        return np.load(self.path/str(size)/f'{chrom}.npy', mmap_mode='r')
+
+    def pick_size(self, span: int, max_windows: int = 2_000) -> int:
+        "Smallest cached size giving at most `max_windows` windows over `span` bases (else the largest size)"
+        return next((size for size in self.sizes if span / size <= max_windows), self.sizes[-1])
+
+    def view(self, chrom: Optional[Union[str, List[str]]] = None, start: Optional[int] = None, end: Optional[int] = None,
+             metric: str = 'unconverted', size: Optional[int] = None, max_windows: int = 2_000,
+             offsets: Optional[dict] = None) -> pd.DataFrame:
+        """
+        Windows of `chrom` (a chrom, a list, or None for all, in name order) with start <= Pos < end, at `size` or, by default,
+        the size chosen by `pick_size` for the span viewed. Columns follow windows.windows_*: Chrom, Pos, Unconverted,
+        Converted, Ratio for the 'unconverted'/'converted' metrics, or Chrom, Pos, Depth (mean) for 'depth'.
+        Given chr `offsets` (see windows.genome_pos), adds 'Pos_genome'.
+        """
+        if metric not in PYRAMID_METRICS: raise ValueError(f"Unknown metric: {metric}")
+        chroms = list(self.chroms) if chrom is None else [str(c) for c in np.atleast_1d(chrom)]
+        chroms = [c for c in chroms if c in self.chroms]
+        if size is None:
+            span = sum(min(self.chroms[c]['end'] + 1, end or np.inf) - (start or 0) for c in chroms)
+            size = self.pick_size(max(span, 1), max_windows)
+        frames = []
+        for c in chroms:
+            records = self.level(size, c)
+            lo = np.searchsorted(records['Pos'], start // size * size) if start else 0
+            hi = np.searchsorted(records['Pos'], end) if end else len(records)
+            records = records[lo:hi]
+            df = pd.DataFrame({'Chrom': c, 'Pos': records['Pos']}, index=pd.RangeIndex(len(records)))
+            if metric == 'depth':
+                df['Depth'] = records['Depth'] / records['Count']
+            else:
+                df['Unconverted'], df['Converted'] = records['Unconverted'], records['Converted']
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    df['Ratio'] = records['Unconverted' if metric == 'unconverted' else 'Converted'] / (
+                        records['Unconverted'] + records['Converted'])
+            frames.append(df)
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Chrom', 'Pos'])
+        df.attrs['size'] = size
+        return genome_pos(df, offsets) if offsets else df
+
+
+def pyramid_view(cache_dir: Union[str, Path], sample: str, chrom=None, start=None, end=None,
+                 metric: str = 'unconverted', size=None, max_windows: int = 2_000, offsets=None) -> pd.DataFrame:
+    "Windows of `sample` from its pyramid in `cache_dir`; see Pyramid.view"
+    return Pyramid(Path(cache_dir)/str(sample)).view(chrom, start, end, metric, size, max_windows, offsets)
+
+
+def export_bedgraph(cache_dir: Union[str, Path], sample: str, metric: str = 'unconverted', size: Optional[int] = None,
+                    out: Optional[Union[str, Path]] = None, prefix: str = '') -> Path:
+    """
+    Write `metric` of `sample` at `size` (default: the finest cached size) as a bedGraph for igv-webapp,
+    to `out` (default: <cache_dir>/<sample>.<metric>.<size>.bedgraph). Windows cover 1-based Pos [Pos, Pos + size),
+    written as 0-based BED intervals; windows without coverage are skipped. `prefix` is prepended to chrom names
+    (e.g. 'chr' for UCSC-style genomes). Returns the bedGraph path.
+    """
+    pyramid = Pyramid(Path(cache_dir)/str(sample))
+    size = size or pyramid.sizes[0]
+    out = Path(out or Path(cache_dir)/f'{sample}.{metric}.{size}.bedgraph')
+    df = pyramid.view(metric=metric, size=size)
+    value = df['Depth'] if metric == 'depth' else df['Ratio']
+    bed = pd.DataFrame({'chrom': prefix + df['Chrom'].astype(str), 'start': (df['Pos'] - 1).clip(lower=0),
+                        'end': df['Pos'] + size - 1, 'value': value.round(4)})[value.notna()]
+    tmp = out.with_name(f'.{out.name}.tmp')
+    with open(tmp, 'w') as fh:
+        print(f'track type=bedGraph name="{sample} {metric}" description="{sample} {metric} ({size} bp windows)"', file=fh)
+        bed.to_csv(fh, sep='\t', header=False, index=False)
+    os.replace(tmp, out)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build zoom-level pyramids from a site table dataset and export bedGraph tracks")
+    parser.add_argument("site_dir", help="Site table dataset (see site_table.py)")
+    parser.add_argument("cache_dir", help="Pyramid cache directory")
+    parser.add_argument("samples", nargs="+", help="Samples to build")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(PYRAMID_SIZES), help=f"Window sizes (default: {' '.join(map(str, PYRAMID_SIZES))})")
+    parser.add_argument("--bedgraph", choices=PYRAMID_METRICS, nargs="*", default=[], help="Metrics to export as bedGraph")
+    parser.add_argument("--bedgraph_size", type=int, default=None, help="Window size of exported bedGraphs (default: finest)")
+    parser.add_argument("--prefix", default="", help="Prefix for chrom names in bedGraphs (e.g. chr)")
+    args = parser.parse_args()
+
+    for sample in args.samples:
+        print(f"{sample} -> {build_pyramid(args.site_dir, args.cache_dir, sample, args.sizes)}")
+        for metric in args.bedgraph:
+            print(f"  {export_bedgraph(args.cache_dir, sample, metric, args.bedgraph_size, prefix=args.prefix)}")
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
 import os
-import re
+import json
 from collections import defaultdict
+from collections.abc import Mapping
 from pathlib import Path
 from itertools import dropwhile
 from subprocess import run
+from find_cmers import fasta_index
 
 # Search up path for the first 'reference' location that contains 'fasta'
 # Expected structure: reference/fasta/ reference/hisat3n reference/meth
@@ -42,10 +44,41 @@ def get_ref(ref, type):
     return None
 
 def get_chr(fasta_file, as_str=False):
-    'Returns a list of chr in fastafile'
-    chrs = [line[1:].split()[0] for line in open(fasta_file) if line.startswith('>')]
+    'Returns a list of chr in fastafile, read from its `.fai` index (built and saved if missing, else from its header lines)'
+    chrs = fasta_headers(fasta_file)
     return ' '.join(chrs) if as_str else chrs
 
+def get_chr_len(fasta_file):
+    '''
+    Returns a dict of {chr: length} for fastafile, read from its `.fai` index (built and saved if missing,
+    else counted by streaming the fasta)
+    Example: get_chr_len(get_ref('lambda','fa')) -> {'lambda': 48502}
+    '''
+    try:
+        return {chr: length for chr, (length, *_) in fasta_index(fasta_file).items()}
+    except (ValueError, OSError):
+        lens, chr = {}, None
+        with open(fasta_file, 'rb') as fh:
+            for line in fh:
+                if line.startswith(b'>'):
+                    chr = line[1:].split()[0].decode()
+                    lens[chr] = 0
+                elif chr is not None:
+                    lens[chr] += len(line.rstrip(b'\r\n'))
+        return lens
+
+def chr_offsets(chr_lens, chrs=None):
+    '''
+    Takes a dict of {chr: length} and returns a dict of {chr: offset}, the genome-wide position of each chr,
+    with chrs laid end to end in the order of `chrs` (default: order of `chr_lens`)
+    Example: chr_offsets({'1': 100, '2': 50, 'X': 80}, ['1','2','X']) -> {'1': 0, '2': 100, 'X': 150}
+    '''
+    chrs = list(chr_lens) if chrs is None else chrs
+    offsets, total = {}, 0
+    for chr in chrs:
+        offsets[chr], total = total, total + chr_lens[chr]
+    return offsets
+
 def mkrefs(refs):
     """
     Takes a list of refs and returns an alpha sorted string conjoining the refs with '_'
@@ -81,27 +114,74 @@ def index_refs(refs):
     run(command)
     return(f'{idx_ref} hisat-3n index created: {idx_path}')
 
+def fasta_headers(fasta_file):
+    'Returns the chr names of fasta_file from its `.fai` index, or from a scan of its header lines if it cannot be indexed'
+    try:
+        return list(fasta_index(fasta_file))
+    except (ValueError, OSError):
+        with open(fasta_file, 'rb') as fh:
+            return [line[1:].split()[0].decode() for line in fh if line.startswith(b'>')]
+
 def fasta_map(reference):
     """
     Create a global mapping of fasta header names to fasta fiilename
+    Headers are read from each fasta's `.fai` index (built if missing, else from its header lines), and persisted with each
+    file's size and mtime to `fasta/.fasta_map.json`, so unchanged fastas are never reopened
     """
     fasta_path = Path(reference)
-    filters = {}
-    pattern = re.compile(r'^>(\S*)')
+    cache_fn = fasta_path/'.fasta_map.json'
+    try:
+        cache = json.loads(cache_fn.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    headers, filters = {}, {}
     for filepath in fasta_path.glob('*.fa'):
-        with filepath.open('r') as file:
-            for line in file:
-                match = pattern.match(line)
-                if match:
-                    key = match.group(1)
-                    filters[key] = filepath.stem
+        stat = filepath.stat()
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = cache.get(filepath.name)
+        chrs = cached[1] if cached and cached[0] == key else fasta_headers(filepath)
+        headers[filepath.name] = [key, chrs]
+        for header in chrs:
+            filters[header] = filepath.stem
+    if headers != cache:
+        try:
+            tmp = cache_fn.with_name(f'{cache_fn.name}.{os.getpid()}')
+            tmp.write_text(json.dumps(headers))
+            os.replace(tmp, cache_fn)
+        except OSError:
+            pass
     return filters
 
+class LazyDict(Mapping):
+    """
+    A read-only mapping built by `loader()` on first access, so that importing costs nothing until it is used
+    Example: refs2fasta = LazyDict(lambda: fasta_map(ref_path/'fasta'))
+    """
+    def __init__(self, loader):
+        self._loader, self._data = loader, None
+    @property
+    def data(self):
+        if self._data is None: self._data = self._loader()
+        return self._data
+    def reload(self):
+        self._data = None
+    def __getitem__(self, key):
+        return self.data[key]
+    def __iter__(self):
+        return iter(self.data)
+    def __len__(self):
+        return len(self.data)
+    def __repr__(self):
+        return repr(self.data)
+
+def _fasta2refs():
+    fasta2refs = {}
+    for k, v in refs2fasta.items():
+        fasta2refs.setdefault(v, []).append(k)
+    return fasta2refs
 
-# Create a global mapping of fasta header names to fasta fiilename
-refs2fasta = fasta_map(ref_path/'fasta')
+# Create a global mapping of fasta header names to fasta fiilename (built lazily on first use)
+refs2fasta = LazyDict(lambda: fasta_map(ref_path/'fasta'))
 
-# Creates a global mapping of fasta filenames to a list of headers
-fasta2refs = {}
-for k, v in refs2fasta.items():
-    fasta2refs.setdefault(v, []).append(k)
+# Creates a global mapping of fasta filenames to a list of headers (built lazily on first use)
+fasta2refs = LazyDict(_fasta2refs)
@@ -6,6 +6,7 @@
 #include <Python.h>
 #include <stdint.h>
 #include <stdlib.h>
+#include <string.h>
 
 static unsigned char seq_comp_table[256] = {
     0,   1,   2,   3,   4,   5,   6,   7,   8,   9,   10,  11,  12,  13,  14,
@@ -27,29 +28,318 @@ static unsigned char seq_comp_table[256] = {
     240, 241, 242, 243, 244, 245, 246, 247, 248, 249, 250, 251, 252, 253, 254,
     255};
 
-static PyObject* seqpy_revcomp(PyObject* self, PyObject* args) {
-  PyObject* r;
-  char *seq, *rev;
-  Py_ssize_t i, len;
-  PyArg_ParseTuple(args, "s#", &seq, &len);
-  rev = (char*)malloc(len);
-  for (i = 0; i < len; ++i) rev[len - i - 1] = seq_comp_table[(uint8_t)seq[i]];
-  r = Py_BuildValue("s#", rev, len);
-  free(rev);
+/* In-silico bisulfite conversion tables, filled in at module init */
+static unsigned char c2t_table[256], g2a_table[256];
+
+/* Buffers larger than this are processed with the GIL released */
+#define SEQPY_NOGIL_LEN 65536
+
+typedef void (*seq_kernel)(unsigned char* out, const unsigned char* in, Py_ssize_t len, const unsigned char* table);
+
+static void kernel_revcomp(unsigned char* out, const unsigned char* in, Py_ssize_t len, const unsigned char* table) {
+  Py_ssize_t i, j;
+  unsigned char c;
+  if (out == in) {
+    for (i = 0, j = len - 1; i < j; ++i, --j) {
+      c = seq_comp_table[out[i]];
+      out[i] = seq_comp_table[out[j]];
+      out[j] = c;
+    }
+    if (i == j) out[i] = seq_comp_table[out[i]];
+  } else {
+    for (i = 0; i < len; ++i) out[len - i - 1] = seq_comp_table[in[i]];
+  }
+}
+
+static void kernel_translate(unsigned char* out, const unsigned char* in, Py_ssize_t len, const unsigned char* table) {
+  Py_ssize_t i;
+  for (i = 0; i < len; ++i) out[i] = table[in[i]];
+}
+
+static void run_kernel(seq_kernel kernel, unsigned char* out, const unsigned char* in, Py_ssize_t len,
+                       const unsigned char* table) {
+  if (len > SEQPY_NOGIL_LEN) {
+    Py_BEGIN_ALLOW_THREADS
+    kernel(out, in, len, table);
+    Py_END_ALLOW_THREADS
+  } else {
+    kernel(out, in, len, table);
+  }
+}
+
+/* Read-only view of a str (as UTF-8) or of any object supporting the buffer protocol */
+typedef struct {
+  Py_buffer view;
+  const unsigned char* buf;
+  Py_ssize_t len;
+  int has_view;
+} seq_arg;
+
+static int seq_arg_get(PyObject* obj, seq_arg* arg) {
+  arg->has_view = 0;
+  if (PyUnicode_Check(obj)) {
+    arg->buf = (const unsigned char*)PyUnicode_AsUTF8AndSize(obj, &arg->len);
+    return arg->buf == NULL ? -1 : 0;
+  }
+  if (PyObject_GetBuffer(obj, &arg->view, PyBUF_SIMPLE) < 0) return -1;
+  arg->has_view = 1;
+  arg->buf = (const unsigned char*)arg->view.buf;
+  arg->len = arg->view.len;
+  return 0;
+}
+
+static void seq_arg_release(seq_arg* arg) {
+  if (arg->has_view) PyBuffer_Release(&arg->view);
+}
+
+/* Apply 'kernel' out-of-place: str -> str, any other buffer -> bytes */
+static PyObject* seq_transform(PyObject* obj, seq_kernel kernel, const unsigned char* table) {
+  PyObject *r, *tmp;
+  seq_arg arg;
+  if (seq_arg_get(obj, &arg) < 0) return NULL;
+  if (PyUnicode_Check(obj) && PyUnicode_IS_ASCII(obj)) {
+    r = PyUnicode_New(arg.len, 127);
+    if (r != NULL) run_kernel(kernel, PyUnicode_1BYTE_DATA(r), arg.buf, arg.len, table);
+  } else {
+    r = PyBytes_FromStringAndSize(NULL, arg.len);
+    if (r != NULL) run_kernel(kernel, (unsigned char*)PyBytes_AS_STRING(r), arg.buf, arg.len, table);
+    if (r != NULL && PyUnicode_Check(obj)) {
+      tmp = r;
+      r = PyUnicode_DecodeUTF8(PyBytes_AS_STRING(tmp), arg.len, "strict");
+      Py_DECREF(tmp);
+    }
+  }
+  seq_arg_release(&arg);
+  return r;
+}
+
+/* Apply 'kernel' in place to a writable buffer */
+static PyObject* seq_transform_inplace(PyObject* obj, seq_kernel kernel, const unsigned char* table) {
+  Py_buffer view;
+  if (PyObject_GetBuffer(obj, &view, PyBUF_WRITABLE) < 0) return NULL;
+  run_kernel(kernel, (unsigned char*)view.buf, (const unsigned char*)view.buf, view.len, table);
+  PyBuffer_Release(&view);
+  Py_RETURN_NONE;
+}
+
+static PyObject* seq_transform_batch(PyObject* seqs, seq_kernel kernel, const unsigned char* table) {
+  PyObject *fast, *r, *item;
+  Py_ssize_t i, n;
+  fast = PySequence_Fast(seqs, "expected a list or sequence of sequences");
+  if (fast == NULL) return NULL;
+  n = PySequence_Fast_GET_SIZE(fast);
+  r = PyList_New(n);
+  if (r == NULL) goto done;
+  for (i = 0; i < n; ++i) {
+    item = seq_transform(PySequence_Fast_GET_ITEM(fast, i), kernel, table);
+    if (item == NULL) {
+      Py_CLEAR(r);
+      goto done;
+    }
+    PyList_SET_ITEM(r, i, item);
+  }
+done:
+  Py_DECREF(fast);
   return r;
 }
 
+static PyObject* seqpy_revcomp(PyObject* self, PyObject* obj) {
+  return seq_transform(obj, kernel_revcomp, NULL);
+}
+
+static PyObject* seqpy_revcomp_inplace(PyObject* self, PyObject* obj) {
+  return seq_transform_inplace(obj, kernel_revcomp, NULL);
+}
+
+static PyObject* seqpy_revcomp_batch(PyObject* self, PyObject* seqs) {
+  return seq_transform_batch(seqs, kernel_revcomp, NULL);
+}
+
+static PyObject* seqpy_revcomp_packed(PyObject* self, PyObject* args) {
+  PyObject *data_obj, *offsets_obj, *r = NULL;
+  Py_buffer data, offsets;
+  const int64_t* offs;
+  unsigned char* out;
+  Py_ssize_t i, n;
+  if (!PyArg_ParseTuple(args, "OO", &data_obj, &offsets_obj)) return NULL;
+  if (PyObject_GetBuffer(data_obj, &data, PyBUF_SIMPLE) < 0) return NULL;
+  if (PyObject_GetBuffer(offsets_obj, &offsets, PyBUF_FORMAT) < 0) {
+    PyBuffer_Release(&data);
+    return NULL;
+  }
+  if (offsets.itemsize != 8 || offsets.format == NULL || strchr("qlQL", offsets.format[strlen(offsets.format) - 1]) == NULL) {
+    PyErr_SetString(PyExc_TypeError, "offsets must be a buffer of 64-bit integers");
+    goto done;
+  }
+  offs = (const int64_t*)offsets.buf;
+  n = offsets.len / 8;
+  for (i = 0; i < n; ++i) {
+    if (offs[i] < 0 || offs[i] > data.len || (i > 0 && offs[i] < offs[i - 1])) {
+      PyErr_SetString(PyExc_ValueError, "offsets must be non-decreasing and within data");
+      goto done;
+    }
+  }
+  r = PyBytes_FromStringAndSize((const char*)data.buf, data.len);
+  if (r == NULL) goto done;
+  out = (unsigned char*)PyBytes_AS_STRING(r);
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 1; i < n; ++i) kernel_revcomp(out + offs[i - 1], out + offs[i - 1], offs[i] - offs[i - 1], NULL);
+  Py_END_ALLOW_THREADS
+done:
+  PyBuffer_Release(&offsets);
+  PyBuffer_Release(&data);
+  return r;
+}
+
+static PyObject* seqpy_c2t(PyObject* self, PyObject* obj) {
+  return seq_transform(obj, kernel_translate, c2t_table);
+}
+
+static PyObject* seqpy_g2a(PyObject* self, PyObject* obj) {
+  return seq_transform(obj, kernel_translate, g2a_table);
+}
+
+static PyObject* seqpy_c2t_inplace(PyObject* self, PyObject* obj) {
+  return seq_transform_inplace(obj, kernel_translate, c2t_table);
+}
+
+static PyObject* seqpy_g2a_inplace(PyObject* self, PyObject* obj) {
+  return seq_transform_inplace(obj, kernel_translate, g2a_table);
+}
+
+static PyObject* seqpy_c2t_batch(PyObject* self, PyObject* seqs) {
+  return seq_transform_batch(seqs, kernel_translate, c2t_table);
+}
+
+static PyObject* seqpy_g2a_batch(PyObject* self, PyObject* seqs) {
+  return seq_transform_batch(seqs, kernel_translate, g2a_table);
+}
+
+#define IS_C(c) ((c) == 'C' || (c) == 'c')
+#define IS_G(c) ((c) == 'G' || (c) == 'g')
+
+static PyObject* seqpy_count_c(PyObject* self, PyObject* obj) {
+  seq_arg arg;
+  Py_ssize_t i, n = 0;
+  if (seq_arg_get(obj, &arg) < 0) return NULL;
+  for (i = 0; i < arg.len; ++i) n += IS_C(arg.buf[i]);
+  seq_arg_release(&arg);
+  return PyLong_FromSsize_t(n);
+}
+
+static PyObject* seqpy_count_cpg(PyObject* self, PyObject* obj) {
+  seq_arg arg;
+  Py_ssize_t i, n = 0;
+  if (seq_arg_get(obj, &arg) < 0) return NULL;
+  for (i = 0; i + 1 < arg.len; ++i) n += IS_C(arg.buf[i]) && IS_G(arg.buf[i + 1]);
+  seq_arg_release(&arg);
+  return PyLong_FromSsize_t(n);
+}
+
+/* Classify a motif starting with its C, as in human2.classify_motif: 0=CG, 1=CHG, 2=CHH, 3=Other */
+static const char* context_names[] = {"CG", "CHG", "CHH", "Other"};
+
+static int classify_context(const unsigned char* m, Py_ssize_t len) {
+  if (len < 1 || m[0] != 'C') return 3;
+  if (len >= 2 && m[1] == 'G') return 0;
+  if (len < 3) return 3;
+  return m[2] == 'G' ? 1 : 2;
+}
+
+static PyObject* seqpy_context(PyObject* self, PyObject* obj) {
+  seq_arg arg;
+  int ctx;
+  if (seq_arg_get(obj, &arg) < 0) return NULL;
+  ctx = classify_context(arg.buf, arg.len);
+  seq_arg_release(&arg);
+  return PyUnicode_FromString(context_names[ctx]);
+}
+
+static PyObject* seqpy_context_batch(PyObject* self, PyObject* seqs) {
+  PyObject *fast, *r, *names[4];
+  seq_arg arg;
+  Py_ssize_t i, n;
+  int k, ctx;
+  fast = PySequence_Fast(seqs, "expected a list or sequence of motifs");
+  if (fast == NULL) return NULL;
+  n = PySequence_Fast_GET_SIZE(fast);
+  r = PyList_New(n);
+  for (k = 0; k < 4; ++k) names[k] = PyUnicode_InternFromString(context_names[k]);
+  for (i = 0; r != NULL && i < n; ++i) {
+    if (seq_arg_get(PySequence_Fast_GET_ITEM(fast, i), &arg) < 0) {
+      Py_CLEAR(r);
+      break;
+    }
+    ctx = classify_context(arg.buf, arg.len);
+    seq_arg_release(&arg);
+    Py_INCREF(names[ctx]);
+    PyList_SET_ITEM(r, i, names[ctx]);
+  }
+  for (k = 0; k < 4; ++k) Py_XDECREF(names[k]);
+  Py_DECREF(fast);
+  return r;
+}
+
+static PyObject* seqpy_context_counts(PyObject* self, PyObject* obj) {
+  seq_arg arg;
+  Py_ssize_t i, counts[3] = {0, 0, 0};
+  if (seq_arg_get(obj, &arg) < 0) return NULL;
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < arg.len; ++i) {
+    if (!IS_C(arg.buf[i]) || i + 1 >= arg.len) continue;
+    if (IS_G(arg.buf[i + 1])) counts[0]++;
+    else if (i + 2 < arg.len) counts[IS_G(arg.buf[i + 2]) ? 1 : 2]++;
+  }
+  Py_END_ALLOW_THREADS
+  seq_arg_release(&arg);
+  return Py_BuildValue("(nnn)", counts[0], counts[1], counts[2]);
+}
+
 static PyMethodDef seqpy_methods[] = {
-    {"revcomp",
-     seqpy_revcomp,
-     METH_VARARGS,
-     "Reverse complement a DNA sequence"},
+    {"revcomp", seqpy_revcomp, METH_O,
+     "Reverse complement a DNA sequence: str -> str, bytes-like -> bytes"},
+    {"revcomp_inplace", seqpy_revcomp_inplace, METH_O,
+     "Reverse complement a writable buffer (bytearray, memoryview, NumPy uint8) in place"},
+    {"revcomp_batch", seqpy_revcomp_batch, METH_O,
+     "Reverse complement each sequence in a list, returning a list"},
+    {"revcomp_packed", seqpy_revcomp_packed, METH_VARARGS,
+     "revcomp_packed(data, offsets): reverse complement each data[offsets[i]:offsets[i+1]] segment,\n"
+     "where offsets is a buffer of int64, returning bytes with segments in their original order"},
+    {"c2t", seqpy_c2t, METH_O, "In-silico C->T conversion: str -> str, bytes-like -> bytes"},
+    {"g2a", seqpy_g2a, METH_O, "In-silico G->A conversion: str -> str, bytes-like -> bytes"},
+    {"c2t_inplace", seqpy_c2t_inplace, METH_O, "In-silico C->T conversion of a writable buffer in place"},
+    {"g2a_inplace", seqpy_g2a_inplace, METH_O, "In-silico G->A conversion of a writable buffer in place"},
+    {"c2t_batch", seqpy_c2t_batch, METH_O, "In-silico C->T conversion of each sequence in a list"},
+    {"g2a_batch", seqpy_g2a_batch, METH_O, "In-silico G->A conversion of each sequence in a list"},
+    {"count_c", seqpy_count_c, METH_O, "Count of C (either case) in a sequence"},
+    {"count_cpg", seqpy_count_cpg, METH_O, "Count of CG dinucleotides (either case) in a sequence"},
+    {"context", seqpy_context, METH_O,
+     "Classify a motif starting at its C as 'CG', 'CHG', 'CHH' or 'Other' (uppercase only)"},
+    {"context_batch", seqpy_context_batch, METH_O, "Classify each motif in a list, returning a list"},
+    {"context_counts", seqpy_context_counts, METH_O,
+     "Counts (CG, CHG, CHH) of the Cs (either case) on the (+) strand of a sequence;\n"
+     "Cs too close to the end to classify are skipped"},
     {NULL, NULL, 0, NULL}};
 
+static void init_tables(void) {
+  int i;
+  for (i = 0; i < 256; ++i) c2t_table[i] = g2a_table[i] = (unsigned char)i;
+  c2t_table['C'] = 'T';
+  c2t_table['c'] = 't';
+  g2a_table['G'] = 'A';
+  g2a_table['g'] = 'a';
+}
+
 #if PY_MAJOR_VERSION >= 3
 static struct PyModuleDef seqpy_module =
     {PyModuleDef_HEAD_INIT, "seqpy", NULL, -1, seqpy_methods};
-PyMODINIT_FUNC PyInit_seqpy(void) { return PyModule_Create(&seqpy_module); }
+PyMODINIT_FUNC PyInit_seqpy(void) {
+  init_tables();
+  return PyModule_Create(&seqpy_module);
+}
 #else
-PyMODINIT_FUNC initseqpy(void) { Py_InitModule3("seqpy", seqpy_methods, NULL); }
+PyMODINIT_FUNC initseqpy(void) {
+  init_tables();
+  Py_InitModule3("seqpy", seqpy_methods, NULL);
+}
 #endif
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Genomic interval index for region queries over per-sample site tables
+# Each sample's sites are stored sorted by (Chrom, Pos) as one memory-mapped .npy per column:
+#     <index_dir>/<sample>/{Pos,Strand,Converted,Unconverted,Depth,Ratio_conv,Ratio_unconv,Motif}.npy
+#     <index_dir>/<sample>/bins.npy     first row of each `bin_size` Pos bin, per chromosome
+#     <index_dir>/<sample>/index.json   chrom -> row range and bins range, Strand/Motif dictionaries, bin_size
+# A query reads one bin entry, binary searches within the bin and then touches only the matching rows.
+# Build from a site table dataset (see site_table.py; convert TSVs with tsv2site_table first).
+
+import argparse, io, json, shutil
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import site_table
+
+INDEX_COLUMNS = ['Pos', 'Strand', 'Converted', 'Unconverted', 'Depth', 'Ratio_conv', 'Ratio_unconv', 'Motif']
+DICT_COLUMNS = ['Strand', 'Motif']
+BIN_SIZE = 1 << 16
+
+
+def _dtype(col: str) -> np.dtype:
+    if col in DICT_COLUMNS: return np.dtype('int32')
+    return np.dtype(site_table.SCHEMA.field(col).type.to_pandas_dtype())
+
+
+def _codes(arr: pa.ChunkedArray, dictionary: List[str]) -> np.ndarray:
+    "Indices of the values of dictionary array `arr` into `dictionary`, which is extended with new values; null -> -1"
+    arr = arr.unify_dictionaries().combine_chunks() if arr.num_chunks else pa.array([], pa.dictionary(pa.int32(), pa.string()))
+    lookup = {value: i for i, value in enumerate(dictionary)}
+    for value in arr.dictionary.to_pylist():
+        if value not in lookup: lookup[value] = len(dictionary); dictionary.append(value)
+    mapping = np.array([lookup[value] for value in arr.dictionary.to_pylist()] + [-1], dtype=np.int32)
+    return mapping[arr.indices.fill_null(-1).to_numpy(zero_copy_only=False)]
+
+
+def build_site_index(site_dir: Union[str, Path], sample: str, index_dir: Union[str, Path],
+                     bin_size: int = BIN_SIZE) -> Path:
+    """
+    Build the index of `sample` from the site table dataset at `site_dir` into `index_dir`/`sample`,
+    replacing any existing index. Chromosomes are read and sorted one at a time, so memory is bounded by the
+    largest chromosome. Returns the sample's index path.
+    """
+    dataset = site_table.site_dataset(site_dir)
+    sample_filter = ds.field('Sample') == str(sample)
+    chroms = sorted({ds.get_partition_keys(f.partition_expression)['Chrom']
+                     for f in dataset.get_fragments(filter=sample_filter)})
+    n = dataset.count_rows(filter=sample_filter)
+    out, tmp = Path(index_dir)/str(sample), Path(index_dir)/f'.{sample}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    arrays = {col: np.lib.format.open_memmap(tmp/f'{col}.npy', mode='w+', dtype=_dtype(col), shape=(n,))
+              for col in INDEX_COLUMNS}
+    meta = {'sample': str(sample), 'bin_size': bin_size, 'chroms': {}, 'dictionaries': {col: [] for col in DICT_COLUMNS}}
+    bins, row, nbins = [], 0, 0
+    for chrom in chroms:
+        table = dataset.to_table(columns=INDEX_COLUMNS, filter=sample_filter & (ds.field('Chrom') == chrom))
+        table = table.take(pc.sort_indices(table['Pos']))
+        end = row + table.num_rows
+        for col in INDEX_COLUMNS:
+            if col in DICT_COLUMNS: arrays[col][row:end] = _codes(table[col], meta['dictionaries'][col])
+            else: arrays[col][row:end] = table[col].to_numpy()
+        pos = arrays['Pos'][row:end]
+        edges = np.arange(0, (int(pos[-1]) if len(pos) else 0) // bin_size + 1, dtype=np.int64) * bin_size
+        meta['chroms'][chrom] = {'rows': [row, end], 'bins': [nbins, nbins + len(edges)]}
+        bins.append(row + np.searchsorted(pos, edges))
+        row, nbins = end, nbins + len(edges)
+    for array in arrays.values(): array.flush()
+    np.save(tmp/'bins.npy', np.concatenate(bins) if bins else np.zeros(0, dtype=np.int64))
+    with open(tmp/'index.json', 'w') as fh: json.dump(meta, fh)
+    shutil.rmtree(out, ignore_errors=True)
+    tmp.rename(out)
+    _open_site_index.cache_clear()
+    return out
+
+
+class SiteIndex:
+    """
+    Memory-mapped site index of one sample (see `build_site_index`).
+    Positions are 1-based and ranges are half-open, start <= Pos < end, as in site_table.read_site_table.
+    Example: SiteIndex('site_index/S1').query('1', 1_000_000, 2_000_000)
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path/'index.json') as fh: meta = json.load(fh)
+        self.sample, self.bin_size = meta['sample'], meta['bin_size']
+        self.chroms, self.dictionaries = meta['chroms'], meta['dictionaries']
+        self.bins = np.load(self.path/'bins.npy', mmap_mode='r')
+        self.columns = {col: np.load(self.path/f'{col}.npy', mmap_mode='r') for col in INDEX_COLUMNS}
+
+    def __repr__(self):
+        return f"SiteIndex({str(self.path)!r}, chroms={len(self.chroms)}, rows={len(self.columns['Pos']):,})"
+
+    def _first(self, chrom: str, pos: Optional[int]) -> int:
+        "First row of `chrom` with Pos >= `pos`: one bin lookup, then a binary search within that bin"
+        (lo, hi), (b0, b1) = self.chroms[chrom]['rows'], self.chroms[chrom]['bins']
+        if pos is None or pos <= 0: return lo
+        i = b0 + pos // self.bin_size
+        if i >= b1: return hi
+        a, b = int(self.bins[i]), int(self.bins[i + 1]) if i + 1 < b1 else hi
+        return a + int(np.searchsorted(self.columns['Pos'][a:b], pos))
+
+    def rows(self, chrom: str, start: Optional[int] = None, end: Optional[int] = None) -> Tuple[int, int]:
+        "Row range [lo, hi) of sites on `chrom` with start <= Pos < end; (0, 0) for a chrom without sites"
+        chrom = str(chrom)
+        if chrom not in self.chroms: return 0, 0
+        lo = self._first(chrom, start)
+        hi = self.chroms[chrom]['rows'][1] if end is None else self._first(chrom, end)
+        return lo, max(lo, hi)
+
+    def take(self, rows: np.ndarray, chroms: np.ndarray, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        "Site table frame (Sample, Chrom, ...) of `rows` with their `chroms`, reading only those rows"
+        df = pd.DataFrame({'Sample': self.sample, 'Chrom': chroms}, index=pd.RangeIndex(len(rows)))
+        for col in columns or INDEX_COLUMNS:
+            values = self.columns[col][rows]
+            if col in DICT_COLUMNS:
+                df[col] = pd.Categorical.from_codes(values, categories=self.dictionaries[col])
+            else:
+                df[col] = values.astype('int64') if values.dtype.kind == 'u' else values
+        return df
+
+    def query(self, chrom: str, start: Optional[int] = None, end: Optional[int] = None,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+        "Sites on `chrom` with start <= Pos < end (default: the whole chromosome)"
+        lo, hi = self.rows(chrom, start, end)
+        return self.take(np.arange(lo, hi), np.full(hi - lo, str(chrom), dtype=object), columns)
+
+    def query_regions(self, regions: Union[pd.DataFrame, Iterable], columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Sites within each BED-style region (0-based, half-open), as one frame with a 'Region' column holding
+        the region's 'name' (or its row number). Sites in overlapping regions are repeated, once per region.
+        `regions` is a frame with 'chrom', 'start', 'end' and optional 'name' (see `read_bed`) or (chrom, start, end) tuples.
+        """
+        if not isinstance(regions, pd.DataFrame):
+            regions = pd.DataFrame(list(regions), columns=['chrom', 'start', 'end'])
+        names = regions['name'] if 'name' in regions else pd.Series(range(len(regions)), index=regions.index)
+        ranges = [self.rows(chrom, start + 1, end + 1)
+                  for chrom, start, end in zip(regions['chrom'].astype(str), regions['start'], regions['end'])]
+        lo, hi = np.array(ranges, dtype=np.int64).reshape(-1, 2).T
+        counts = hi - lo
+        rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        df = self.take(rows, np.repeat(regions['chrom'].astype(str).to_numpy(), counts), columns)
+        df.insert(0, 'Region', np.repeat(names.to_numpy(), counts))
+        return df
+
+
+@lru_cache(maxsize=None)
+def _open_site_index(path: Path, mtime_ns: int) -> SiteIndex:
+    return SiteIndex(path)
+
+
+def open_site_index(index_dir: Union[str, Path], sample: str) -> SiteIndex:
+    "The SiteIndex of `sample` in `index_dir`, cached until the index is rebuilt (keyed on the mtime of index.json)"
+    path = Path(index_dir)/str(sample)
+    return _open_site_index(path, (path/'index.json').stat().st_mtime_ns)
+
+
+def query(index_dir: Union[str, Path], sample: str, chrom: str, start: Optional[int] = None,
+          end: Optional[int] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    "Sites of `sample` on `chrom` with start <= Pos < end"
+    return open_site_index(index_dir, sample).query(chrom, start, end, columns)
+
+
+def _get_ref(ref, type):
+    # reference locates its dir on import, which only succeeds from within a workspace
+    from reference import get_ref
+    return get_ref(ref, type)
+
+
+def read_bed(bed: Union[str, Path]) -> pd.DataFrame:
+    "Regions of a BED file, or of reference `bed` (see reference.get_ref), as chrom, start, end and name (if present)"
+    path = bed if Path(bed).exists() else _get_ref(bed, 'bed')
+    if path is None: raise FileNotFoundError(f"No bed file or reference: {bed}")
+    with open(path) as fh:
+        lines = ''.join(line for line in fh if not line.startswith(('#', 'track', 'browser')))
+    df = pd.read_csv(io.StringIO(lines), sep='\t', header=None, dtype={0: str}).iloc[:, :4]
+    return df.set_axis(['chrom', 'start', 'end', 'name'][:df.shape[1]], axis=1).astype({'start': 'int64', 'end': 'int64'})
+
+
+def read_gtf(gtf: Union[str, Path], feature: str = 'gene', name: str = 'gene_name') -> pd.DataFrame:
+    """
+    `feature` records of a GTF file, or of reference `gtf` (see reference.get_ref), as BED-style regions
+    (chrom, 0-based start, end, name), named by attribute `name` (falling back to gene_id)
+    """
+    path = gtf if Path(gtf).exists() else _get_ref(gtf, 'gtf')
+    if path is None: raise FileNotFoundError(f"No gtf file or reference: {gtf}")
+    df = pd.read_csv(path, sep='\t', header=None, comment='#', usecols=[0, 2, 3, 4, 8], dtype={0: str})
+    df = df[df[2] == feature]
+    names = df[8].str.extract(f'{name} "([^"]*)"')[0].fillna(df[8].str.extract('gene_id "([^"]*)"')[0])
+    return pd.DataFrame({'chrom': df[0], 'start': df[3] - 1, 'end': df[4], 'name': names}).reset_index(drop=True)
+
+
+def query_bed(index_dir: Union[str, Path], sample: str, bed: Union[str, Path],
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+    "Sites of `sample` within each region of `bed` (a path or reference name), with a 'Region' column"
+    return open_site_index(index_dir, sample).query_regions(read_bed(bed), columns)
+
+
+def query_gtf(index_dir: Union[str, Path], sample: str, gtf: Union[str, Path], feature: str = 'gene',
+              names: Optional[List[str]] = None, name: str = 'gene_name',
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Sites of `sample` within each `feature` of `gtf` (a path or reference name), optionally only those named in `names`
+    Example: query_gtf('site_index', 'S1', 'GRCh38', names=['BRCA1', 'TP53'])
+    """
+    regions = read_gtf(gtf, feature, name)
+    if names is not None: regions = regions[regions['name'].isin(names)]
+    return open_site_index(index_dir, sample).query_regions(regions, columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build per-sample interval indexes from a site table dataset")
+    parser.add_argument("site_dir", help="Site table dataset (see site_table.py)")
+    parser.add_argument("index_dir", help="Index directory")
+    parser.add_argument("samples", nargs="+", help="Samples to index")
+    parser.add_argument("--bin_size", type=int, default=BIN_SIZE, help=f"Pos bin size (default: {BIN_SIZE})")
+    args = parser.parse_args()
+
+    for sample in args.samples:
+        print(f"{sample} -> {build_site_index(args.site_dir, sample, args.index_dir, args.bin_size)}")
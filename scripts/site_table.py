@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Canonical columnar format for per-sample methylation site tables
+# Site tables (Sample, Chrom, Pos, Strand, Converted, Unconverted, Depth, Ratio_conv, Ratio_unconv, Motif)
+# are stored as a Parquet dataset partitioned hive-style by sample and chromosome:
+#     <out_dir>/Sample=<sample>/Chrom=<chrom>/<sample>-<i>.parquet
+# Strand and Motif are dictionary encoded, Pos and counts are uint32, and every row group carries
+# min/max statistics on Pos, so per-chromosome loads and range queries read only the row groups they need.
+
+import argparse, shutil
+from pathlib import Path
+from typing import List, Optional, Union
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+
+# Dictionary indices are int32, the only index type the Arrow CSV reader can produce
+SCHEMA = pa.schema([
+    ('Sample', pa.string()),
+    ('Chrom', pa.string()),
+    ('Pos', pa.uint32()),
+    ('Strand', pa.dictionary(pa.int32(), pa.string())),
+    ('Converted', pa.uint32()),
+    ('Unconverted', pa.uint32()),
+    ('Depth', pa.uint32()),
+    ('Ratio_conv', pa.float64()),
+    ('Ratio_unconv', pa.float64()),
+    ('Motif', pa.dictionary(pa.int32(), pa.string()))])
+
+COLUMNS = SCHEMA.names
+PARTITIONING = ds.partitioning(pa.schema([('Sample', pa.string()), ('Chrom', pa.string())]), flavor='hive')
+ROW_GROUP_SIZE = 1 << 17
+
+
+def tsv2site_table(fn: Union[str, Path], out_dir: Union[str, Path], block_size: int = 1 << 24,
+                   row_group_size: int = ROW_GROUP_SIZE) -> Path:
+    """
+    Stream a site table TSV (tsv or tsv.gz) into the partitioned Parquet dataset at `out_dir`,
+    reading `block_size` bytes at a time. Each sample in `fn` replaces all of that sample's partitions,
+    including chromosomes no longer present; other samples are kept. The dataset is written to a staging dir
+    first and swapped in per sample, so a failed conversion leaves `out_dir` unchanged.
+    Rows are kept in file order, so Pos statistics per row group are tight when the TSV is sorted by position.
+    Returns `out_dir`.
+    """
+    fn, out_dir = Path(fn), Path(out_dir)
+    stem = fn.name.split('.')[0]
+    staging = out_dir/f'.{stem}.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    try:
+        reader = pacsv.open_csv(fn, read_options=pacsv.ReadOptions(block_size=block_size),
+                                parse_options=pacsv.ParseOptions(delimiter='\t'),
+                                convert_options=pacsv.ConvertOptions(column_types=SCHEMA, include_columns=COLUMNS))
+        ds.write_dataset(reader, staging, format='parquet', partitioning=PARTITIONING,
+                         basename_template=f'{stem}-{{i}}.parquet',
+                         min_rows_per_group=row_group_size, max_rows_per_group=row_group_size,
+                         file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+        for sample_dir in staging.glob('Sample=*'):
+            shutil.rmtree(out_dir/sample_dir.name, ignore_errors=True)
+            sample_dir.rename(out_dir/sample_dir.name)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return out_dir
+
+
+def site_dataset(path: Union[str, Path]) -> ds.Dataset:
+    "The partitioned site table dataset at `path`"
+    return ds.dataset(path, schema=SCHEMA, format='parquet', partitioning=PARTITIONING)
+
+
+def site_filter(samples: Optional[List[str]] = None, chroms: Optional[List[str]] = None,
+                start: Optional[int] = None, end: Optional[int] = None) -> Optional[ds.Expression]:
+    """
+    Dataset filter for `samples` and `chroms` (pruning partitions) and start <= Pos < end (pruning row groups
+    by their Pos statistics). Returns None when there is nothing to filter.
+    """
+    conditions = []
+    if samples is not None: conditions.append(ds.field('Sample').isin([str(s) for s in samples]))
+    if chroms is not None: conditions.append(ds.field('Chrom').isin([str(c) for c in chroms]))
+    if start is not None: conditions.append(ds.field('Pos') >= start)
+    if end is not None: conditions.append(ds.field('Pos') < end)
+    if not conditions: return None
+    expr = conditions[0]
+    for condition in conditions[1:]: expr = expr & condition
+    return expr
+
+
+def read_site_table(path: Union[str, Path], samples: Optional[List[str]] = None, chroms: Optional[List[str]] = None,
+                    start: Optional[int] = None, end: Optional[int] = None,
+                    columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    Read the rows of the site table dataset at `path` for `samples`, `chroms` and start <= Pos < end,
+    with only `columns` (default: all, in `COLUMNS` order). Only matching partitions and row groups are read.
+    """
+    return site_dataset(path).to_table(columns=columns or COLUMNS, filter=site_filter(samples, chroms, start, end))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert site table TSVs to a Parquet dataset partitioned by sample and chromosome")
+    parser.add_argument("out_dir", help="Dataset directory")
+    parser.add_argument("files", nargs="+", help="Site table TSVs (tsv or tsv.gz)")
+    parser.add_argument("--row_group_size", type=int, default=ROW_GROUP_SIZE, help=f"Rows per row group (default: {ROW_GROUP_SIZE})")
+    args = parser.parse_args()
+
+    for fn in args.files:
+        tsv2site_table(fn, args.out_dir, row_group_size=args.row_group_size)
+        print(f"{fn} -> {args.out_dir}")
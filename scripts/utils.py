@@ -10,12 +10,15 @@ Utilities to be used with Jupyter
 """
 
 from find_cmers import *
+from fastq_count import fastq_count, fastq_counts
 from fnames import *
 from reference import *
+from windows import *
 
 from pathlib import Path
 from typing import Dict, Optional, Tuple, List, Union
-import os, sys, re, subprocess, itertools, colorsys, importlib
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, re, json, subprocess, itertools, colorsys, importlib
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -44,34 +47,6 @@ def adaptive_formatter(threshold=1e10):
     return plt.FuncFormatter(format_number)
 
 
-# Windows Functions for setting windows
-def windows_unconverted(df, size=100):
-    "Windows for UBS-seq"
-    return (
-        df.assign(Pos=lambda x: x.Pos // size * size)
-        .groupby(["Chrom", "Pos"])
-        .agg({"Unconverted": "sum", "Converted": "sum"})
-        .assign(Ratio=lambda x: x.Unconverted / (x.Converted + x.Unconverted))
-        .reset_index())
-
-def windows_converted(df, size=100):
-    "Windows for BAT-seq"
-    return (
-        df.assign(Pos=lambda x: x.Pos // size * size)
-        .groupby(["Chrom", "Pos"])
-        .agg({"Unconverted": "sum", "Converted": "sum"})
-        .assign(Ratio=lambda x: x.Converted / (x.Converted + x.Unconverted))
-        .reset_index())
-
-def windows_depth(df, size=100):
-    "Windows for Depth Coverage"
-    return (
-        df.assign(Window=lambda x: x.Pos // size * size)
-        .groupby(["Strand", "Window"])
-        .agg({"Depth": "mean", "Pos": "first"})  # Use mean depth and first position in window
-        .reset_index()
-        .drop(columns=["Window"]))
-
 def reorder_df(df: pd.DataFrame, sample: list, key: str = 'SampleID') -> pd.DataFrame:
     """Reorder DataFrame rows to match the order of values in the given list.
 
@@ -85,24 +60,70 @@ def reorder_df(df: pd.DataFrame, sample: list, key: str = 'SampleID') -> pd.Data
     """
     return df.set_index(key).loc[sample].reset_index()
 
-def mk_read_counts(out_paths,samples):
+def bam_index(bam: Path) -> Optional[Path]:
+    "Returns the .bai or .csi index of `bam` if one exists and is newer than `bam`, otherwise None"
+    for idx in [Path(f'{bam}.bai'), Path(f'{bam}.csi'), bam.with_suffix('.bai')]:
+        if idx.exists() and idx.stat().st_mtime >= bam.stat().st_mtime: return idx
+    return None
+
+def read_count(fn: Path, threads: int = 1, idxstats: bool = False) -> int:
+    """
+    Count reads in `fn` using `threads` threads
+        - file.fq.gz: all records, counted in-process by fastq_count.fastq_count
+        - file.bam: mapped, forward strand, primary alignments (-F4 -F16 -F256)
+        - file.bam with `idxstats` and a .bai/.csi index: all mapped reads, read instantly from the index
+    """
+    if idxstats and fn.suffix == '.bam' and bam_index(fn):
+        result = subprocess.run(["samtools", "idxstats", str(fn)], capture_output=True, text=True, check=True)
+        return sum(int(line.split('\t')[2]) for line in result.stdout.splitlines())
+    if fn.suffix != '.bam':
+        return fastq_count(fn, threads, bases=False)['Reads']
+    cmd = ["samtools", "view", "-@", str(threads), "-F4", "-F16", "-F256", "-c", str(fn)]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return int(result.stdout.strip())
+
+def mk_read_counts(out_paths, samples, threads: int = os.cpu_count(), jobs: Optional[int] = None,
+                   idxstats: bool = False, cache: bool = True):
     """
     Takes out_path::DictList or instance of Path. Only expects (file_R1.fq.gz,file_R2.fq.gz) or file.bam
     Creates a out_path/'prefix'_read_counts.gz file
+        - Counts run concurrently across samples and out_paths as `jobs` (default: one per file, up to `threads`),
+          with the total budget of `threads` split between them
+        - `idxstats`: count all mapped reads from the BAM index when one exists (see read_count)
+        - `cache`: reuse counts from out_path/.read_counts_cache.json for files whose size and mtime are unchanged
     """
-    nc = os.cpu_count()
     if isinstance(out_paths,Path): out_paths = [out_paths]
     (tail,ext) = ('','bam') if list(out_paths[0].glob('*.bam')) else ('_R1','fq.gz')
+    files = {(out_path, sample): fname(out_path, sample + tail, ext) for out_path in out_paths for sample in samples}
+    caches = {}
+    for out_path in out_paths:
+        try:
+            caches[out_path] = json.loads((out_path/'.read_counts_cache.json').read_text()) if cache else {}
+        except (OSError, ValueError):
+            caches[out_path] = {}
+    def key(fn):
+        stat = fn.stat()
+        return [stat.st_size, stat.st_mtime_ns, 'idxstats' if idxstats and fn.suffix == '.bam' and bam_index(fn) else 'view']
+    counts, todo = {}, []
+    for (out_path, sample), fn in files.items():
+        cached = caches[out_path].get(fn.name)
+        if cached and cached[:3] == key(fn): counts[(out_path, sample)] = cached[3]
+        else: todo.append((out_path, sample))
+    jobs = max(1, min(jobs or len(todo), threads, len(todo) or 1))
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {task: pool.submit(read_count, files[task], max(1, threads // jobs), idxstats) for task in todo}
+        for task, future in futures.items(): counts[task] = future.result()
     for out_path in out_paths:
         prefix = str(out_path).split('_')[0]
         with open(fname(out_path,f'{prefix}_read_counts', 'tsv'),'w') as fh:
             print(f'SampleID\tCount',file=fh)
             for sample in samples:
-                if tail == '_R1': cmd = ["samtools", "view", "-@", str(nc), "-c", fname(out_path, sample + tail, ext)]
-                else:             cmd = ["samtools", "view","-@", str(nc), "-F4","-F16","-F256", "-c", fname(out_path, sample + tail, ext)]
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                c = int(result.stdout.strip())
-                print(f'{sample}\t{c}',file=fh)
+                print(f'{sample}\t{counts[(out_path, sample)]}',file=fh)
+        if cache:
+            for sample in samples:
+                fn = files[(out_path, sample)]
+                caches[out_path][fn.name] = key(fn) + [counts[(out_path, sample)]]
+            (out_path/'.read_counts_cache.json').write_text(json.dumps(caches[out_path]))
 
 def get_read_counts(out_paths):
     """
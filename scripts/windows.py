@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Genome-wide positions and window aggregation for site tables (pandas or polars)
+# Kept free of import-time side effects (unlike `utils`, which locates the reference dir on import),
+# so scripts such as pyramid.py can use them anywhere; `utils` re-exports everything here.
+
+import numpy as np
+import pandas as pd
+
+
+def genome_pos(df, offsets, col='Pos_genome'):
+    """
+    Adds `col`, a genome-wide position from 'Chrom' and 'Pos', given chr `offsets` from reference.chr_offsets
+    Example: genome_pos(df, chr_offsets(get_chr_len(get_ref('GRCh38','fa')), [str(i) for i in range(1, 23)] + ['X', 'Y']))
+    """
+    offset = df['Chrom'].astype(object).map(offsets)
+    if offset.isna().any():
+        raise ValueError(f"Chrom missing from offsets: {sorted(set(df['Chrom'][offset.isna()].astype(str)))}")
+    return df.assign(**{col: offset.astype('int64') + df['Pos']})
+
+# Windows Functions for setting windows
+# All are computed by `windows_multi`, which sorts sites once and builds each window size from the previous one
+
+def _window_keys(col):
+    "Sorted integer codes (-1 for missing) and a function mapping codes back to a column like `col`, for pandas or polars `col`"
+    if _is_polars(col):
+        import polars as pl
+        dtype = col.dtype if isinstance(col.dtype, pl.Enum) else pl.Enum(col.drop_nulls().unique().sort().cast(pl.Utf8))
+        codes = col.cast(pl.Utf8).cast(dtype).to_physical().fill_null(-1).to_numpy().astype(np.int64)
+        return codes, lambda keys: dtype.categories.gather(keys).cast(col.dtype).alias(col.name)
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy().astype(np.int64), lambda keys: pd.Categorical.from_codes(keys, dtype=col.dtype)
+    codes, uniques = pd.factorize(col, sort=True)
+    return codes.astype(np.int64), lambda keys: uniques.take(keys)
+
+def _is_polars(df):
+    return type(df).__module__.split('.')[0] == 'polars'
+
+def _coarsen(level, size):
+    "Sums, counts and first original row of each `size` window of a (key, pos)-sorted `level`"
+    win = level['pos'] // size * size
+    change = np.ones(len(win), dtype=bool)
+    change[1:] = (level['key'][1:] != level['key'][:-1]) | (win[1:] != win[:-1])
+    starts = np.flatnonzero(change)
+    if not len(starts): return {**level, 'pos': win}
+    return {'key': level['key'][starts], 'pos': win[starts],
+            'sums': {col: np.add.reduceat(v, starts) for col, v in level['sums'].items()},
+            'count': np.add.reduceat(level['count'], starts), 'first': np.minimum.reduceat(level['first'], starts)}
+
+def window_levels(keys, pos, values, sizes, counts=None):
+    """
+    Single-pass multi-resolution window sums. Sorts rows once by (`keys`, `pos`) and returns {size: level} for
+    each of `sizes`, where a level holds per-window 'key', 'pos' (window start), 'sums' of each of `values`,
+    'count' of rows and 'first' (smallest original row index). Rows with key < 0 are dropped.
+    Each size is aggregated from the next finer level when it is a multiple of it, so after the first level
+    the work is proportional to the number of windows, not rows.
+    Rows that are themselves windows (e.g. a cached level) carry their row `counts`.
+    """
+    keep = np.flatnonzero(keys >= 0)
+    order = keep[np.lexsort((pos[keep], keys[keep]))]
+    count = np.ones(len(order), dtype=np.int64) if counts is None else counts[order].astype(np.int64)
+    base = {'key': keys[order], 'pos': pos[order].astype(np.int64), 'count': count,
+            'sums': {col: v[order].astype(np.float64 if v.dtype.kind == 'f' else np.int64) for col, v in values.items()},
+            'first': order}
+    levels, finer = {}, None
+    for size in sorted(set(sizes)):
+        levels[size] = _coarsen(levels[finer] if finer and size % finer == 0 else base, size)
+        finer = size
+    return levels
+
+def windows_multi(df, sizes=(100, 1_000, 10_000, 100_000), kind='unconverted', offsets=None):
+    """
+    Windows of several `sizes` at once, returning {size: frame} with the same columns and row order as
+    `windows_unconverted`, `windows_converted` or `windows_depth` (`kind` = 'unconverted', 'converted' or 'depth').
+    `df` may be pandas or polars; frames of the same kind are returned. Given chr `offsets` (see genome_pos),
+    'unconverted' and 'converted' windows get 'Pos_genome'.
+    Example: windows = windows_multi(df, [100, 1_000, 10_000, 100_000]); windows[1_000]
+    """
+    if kind not in ('unconverted', 'converted', 'depth'): raise ValueError(f"Unknown kind: {kind}")
+    polars = _is_polars(df)
+    key_col = 'Strand' if kind == 'depth' else 'Chrom'
+    value_cols = ['Depth'] if kind == 'depth' else ['Unconverted', 'Converted']
+    keys, decode = _window_keys(df[key_col])
+    pos = df['Pos'].to_numpy()
+    levels = window_levels(keys, pos, {col: df[col].to_numpy() for col in value_cols}, sizes)
+    windows = {}
+    for size, level in levels.items():
+        if kind == 'depth':
+            data = {'Strand': decode(level['key']), 'Depth': level['sums']['Depth'] / level['count'],
+                    'Pos': pos[level['first']].astype(np.int64)}
+        else:
+            unconverted, converted = level['sums']['Unconverted'], level['sums']['Converted']
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ratio = (unconverted if kind == 'unconverted' else converted) / (converted + unconverted)
+            data = {'Chrom': decode(level['key']), 'Pos': level['pos'],
+                    'Unconverted': unconverted, 'Converted': converted, 'Ratio': ratio}
+        if polars:
+            import polars as pl
+            out = pl.DataFrame(data)
+            if offsets and kind != 'depth':
+                offset = pl.col('Chrom').cast(pl.Utf8).replace_strict(offsets, return_dtype=pl.Int64)
+                out = out.with_columns((offset + pl.col('Pos')).alias('Pos_genome'))
+        else:
+            out = pd.DataFrame(data)
+            if offsets and kind != 'depth': out = genome_pos(out, offsets)
+        windows[size] = out
+    return windows
+
+def windows_unconverted(df, size=100, offsets=None):
+    "Windows for UBS-seq. Given chr `offsets` (see genome_pos), adds 'Pos_genome'"
+    return windows_multi(df, [size], 'unconverted', offsets)[size]
+
+def windows_converted(df, size=100, offsets=None):
+    "Windows for BAT-seq. Given chr `offsets` (see genome_pos), adds 'Pos_genome'"
+    return windows_multi(df, [size], 'converted', offsets)[size]
+
+def windows_depth(df, size=100):
+    "Windows for Depth Coverage: mean depth and first position in each window, per strand"
+    return windows_multi(df, [size], 'depth')[size]